@@ -0,0 +1,70 @@
+import cv2
+from roi_signals import clamp_box
+
+
+class AdaptiveRate:
+    '''Decides when the counter can stop running optical flow on every frame. After the conveyor has been still
+    (|mean conveyor flow| below still_speed outside a cycle) for idle_after seconds the counter goes idle: the frame
+    reader closes the stream and opens it again for one frame every idle interval (FrameReader.set_idle_interval),
+    so nothing is decoded in between, and each frame is only compared with the previous sample over the conveyor
+    box, downscaled and in gray. As soon as the mean absolute difference exceeds motion_thresh the counter returns
+    to full rate.
+    A conveyor start is seen up to one idle interval plus the time to open the stream and decode its first frame
+    late, and full rate frames start after one more open. The first cycle after a stop therefore starts up to about
+    idle interval + 2 x stream open time late (2 s at idle_fps 0.5 plus two RTSP connects): its start time and
+    cycle_length are off by as much, and a forward conveyor move shorter than that is not counted at all.
+    Later cycles are not affected.
+    usage: rate = AdaptiveRate(idle_after=60)
+           if rate.idle:
+               if rate.moved(frame, config): pipeline.restart(frame) # full rate from the next frame
+           else:
+               cycle = pipeline.process(frame)
+               rate.update(pipeline.counter.conv_mean(), pipeline.counter.time_toggle == 1, now)
+    args: idle_after: float: seconds of still conveyor before going idle, 0 never goes idle
+          motion_thresh: float: mean absolute gray level difference over the conveyor box that counts as motion
+          still_speed: float: conveyor flow below which the conveyor counts as still
+          scale: float: downscale of the conveyor box before differencing, averages out sensor noise'''
+
+    def __init__(self, idle_after=60, motion_thresh=2.0, still_speed=0.05, scale=0.25):
+        self.idle_after = idle_after
+        self.motion_thresh = motion_thresh
+        self.still_speed = still_speed
+        self.scale = scale
+        self.idle = False
+        self.still_since = None
+        self.reference = None
+
+    def update(self, conv_mean, in_cycle, now):
+        '''Called with the conveyor state of every frame processed at full rate, returns True when going idle'''
+        if not self.idle_after or in_cycle or not abs(conv_mean) < self.still_speed: # a nan mean is not still
+            self.still_since = None
+            return False
+        if self.still_since is None:
+            self.still_since = now
+        if now - self.still_since < self.idle_after:
+            return False
+        self.idle = True
+        self.reference = None
+        return True
+
+    def sample(self, frame, config):
+        height, width = frame.shape[:2]
+        x0, y0, x1, y1 = clamp_box(config.ul_bound_converyor, config.lr_bound_conveyor, width, height)
+        roi = frame[y0:y1, x0:x1]
+        if roi.size == 0:
+            return roi
+        if roi.ndim == 3:
+            roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(roi, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def moved(self, frame, config):
+        '''Compares an idle frame with the previous one, returns True and leaves idle when the conveyor moved'''
+        sample = self.sample(frame, config)
+        reference, self.reference = self.reference, sample
+        if reference is None or reference.shape != sample.shape or reference.size == 0:
+            return False
+        if cv2.mean(cv2.absdiff(sample, reference))[0] <= self.motion_thresh:
+            return False
+        self.idle = False
+        self.still_since = None
+        return True
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+class BufferPool:
+    '''Named numpy buffers to pass as OpenCV dst= arguments in the frame loop.
+    get() returns the same array for a name while the requested shape and dtype stay the same,
+    so a stream of equal sized frames allocates nothing after the first frame.
+    A new buffer is only allocated when the camera resolution or a configured box changes.
+    usage: buffers = BufferPool()
+           gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=buffers.get('gray', frame.shape[:2]))'''
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    def clear(self):
+        self.buffers.clear()
@@ -0,0 +1,106 @@
+import os
+import threading
+import logging
+import yaml
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError: # polling fallback
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class ConfigWatcher:
+    '''Keeps one yaml document of a config file parsed and up to date, so loops read an attribute instead of
+    checking the file. The file is watched with watchdog (inotify and friends) when it is installed, otherwise its
+    modification time is polled every poll_interval seconds from a background thread. A change is parsed and
+    validated once, and subscribers are called with the new config; a file that fails to load or validate is
+    logged and the previous config is kept. config.yaml holds the counter in document 0 and the processor in document 1.
+    usage: watcher = ConfigWatcher('config.yaml', 0, lambda data: config_default(**data), config_default())
+           watcher.subscribe(lambda config: ...)
+           watcher.start()
+           config = watcher.config
+    args: path: str: yaml file, may hold several documents
+          document: int: index of the document this service uses
+          parse: callable: turns the document (a dict) into a config object, raises on invalid values
+          default: object: config used until the file has been loaded
+          poll_interval: float: seconds between modification time checks when watchdog is not available'''
+
+    def __init__(self, path, document, parse, default=None, poll_interval=2.0):
+        self.path = os.path.abspath(path)
+        self.document = document
+        self.parse = parse
+        self.config = default
+        self.version = 0 # incremented on every applied change
+        self.poll_interval = poll_interval
+        self.subscribers = []
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.observer = None
+        self.thread = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def load(self):
+        '''Reloads the file if it changed since the last load, returns True if a new config was applied'''
+        with self.lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                logging.error(f"Error getting modification time of config file: {e}")
+                return False
+            if mtime == self.mtime:
+                return False
+            try:
+                with open(self.path, 'r') as file:
+                    documents = list(yaml.safe_load_all(file))
+                config = self.parse(documents[self.document] or {})
+            except Exception as e:
+                logging.error(f"Error loading config file {self.path} document {self.document}: {e}")
+                self.mtime = mtime # not retried until the file changes again
+                return False
+            self.mtime = mtime
+            self.config = config
+            self.version += 1
+        logging.info(f"Loaded config {self.path} document {self.document}")
+        for callback in self.subscribers:
+            try:
+                callback(config)
+            except Exception as e:
+                logging.error(f"Error in config subscriber: {e}")
+        return True
+
+    def start(self):
+        self.load()
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(_ChangeHandler(self), os.path.dirname(self.path))
+            self.observer.daemon = True
+            self.observer.start()
+        else:
+            self.thread = threading.Thread(target=self.poll, name='config_watcher', daemon=True)
+            self.thread.start()
+
+    def poll(self):
+        while not self.stop_event.wait(self.poll_interval):
+            self.load()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    # editors often write a temporary file and rename it over the config, so moves count as well
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        paths = (getattr(event, 'src_path', None), getattr(event, 'dest_path', None))
+        if self.watcher.path in [os.path.abspath(p) for p in paths if p]:
+            self.watcher.load()
@@ -0,0 +1,298 @@
+import manageRTSP as rtsp
+from counter_config import config_default, parse_config
+from config_watcher import ConfigWatcher
+from counter_pipeline import CountingPipeline, CycleRecord, read_frame, save_cycle
+from cycle_writer import CycleWriter
+from image_sink import ImageSink
+from cycle_events import CycleNotifier
+from mqtt_publisher import MqttPublisher
+from mqtt_connection import MqttConnection
+from rolling_window import RollingWindow
+from metrics import Metrics
+from loop_profiler import LoopProfiler
+from adaptive_rate import AdaptiveRate
+import cv2
+import numpy as np
+import time
+from datetime import datetime
+import os
+import logging
+
+# Started by casting_counter_1.1.py, which imports this module only in the main process.
+# This script is designed to run on a remote server with a networked IP camera supporting RTSP. 
+# It is designed to count the number of parts that pass a certain point on a conveyor belt. 
+# The script uses optical flow to measure the speed of the conveyor belt and a colour segmentation algorithm to detect the presence of parts. 
+# The script uses a configuration file to set the parameters for the optical flow and colour segmentation algorithms. 
+# The script also uses a SQLite database to store the count data and a MQTT broker to send the count data to a remote server. 
+# The script is designed to run continuously and to be restarted automatically if it crashes. 
+# The script also has a setup mode that allows the user to adjust the parameters of the optical flow and colour segmentation algorithms in real time.
+
+def hsv_segmentation(frame, HSLlower, HSLupper):
+    HSLlower = np.array(HSLlower, int)
+    HSLupper = np.array(HSLupper, int)
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    #create a mask for  colour using inRange function
+    mask = cv2.inRange(hsv, HSLlower, HSLupper)
+
+    #perform bitwise and on the original image arrays using the mask
+    reshsv = cv2.bitwise_and(frame, frame, mask=mask)
+    return reshsv
+
+def brightness_thresh(frame, lower = 245):
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thresh, frame = cv2.threshold(frame, lower, 255,	cv2.THRESH_BINARY)
+    return frame
+
+def image_directory_cleanup(config):
+        try:
+            logging.info('Trying image directory cleanup')
+            os.system("image_clean_up.py")
+            config.image_dir_cleanup = True
+            logging.info('Image directory cleanup ran')
+        except:
+            logging.info('Image directory cleanup failed')
+            pass
+
+def main(config_watcher, frame_reader, name='counter', stop_event=None, heartbeat=None, mqtt_retry=120):
+    '''Frame loop of one camera, used by run() and by counter_supervisor's workers. Runs until config.stop_running
+    is set or stop_event is set.
+    args: config_watcher: ConfigWatcher: config of this camera, reloads are picked up between frames
+          frame_reader: FrameReader: started reader of this camera
+          name: str: profile runs are named after it
+          stop_event: Event: optional, stops the loop when set
+          heartbeat: Value: optional, set to the time after every frame so a supervisor can detect a stall
+          mqtt_retry: float: longest delay in seconds between MQTT reconnect attempts'''
+
+    config = config_watcher.config
+    config_version = config_watcher.version
+
+    sample_rate = RollingWindow(100) # average sample rate
+    ave_sample_rate = 10 # initial default value (driven, not driving)
+
+    # record raw data, juat use for debugging - initialise here
+    record_flow_x = []
+    record_flow_conv = []
+    record_hsv_1_mag = []
+    record_hsv_2_mag = []
+    perf_record = [] # list of dicts to store processed results
+
+    # stage latencies from the frame loop and the writer, image and MQTT threads
+    metrics = Metrics('counter')
+
+    # consumers are notified once a cycle row is committed, so they do not need to poll the database
+    notifier = CycleNotifier(config.event_port)
+    if not (config.event_port and notifier.start()):
+        notifier = None
+
+    # database writes happen on a background thread, the frame loop only queues rows
+    cycle_writer = CycleWriter(config.db_name, config.db_table, config.db_batch_size, config.db_flush_interval,
+                               on_commit=notifier.publish_rows if notifier else None, observe=metrics.observe)
+    cycle_writer.start()
+    image_sink = ImageSink(config.image_dir, config.image_quality, config.image_scale,
+                           config.image_roi, config.image_format, config.image_queue, observe=metrics.observe)
+    image_sink.start()
+
+    # cycle messages are marked published on acknowledgement and replayed from the database after a reconnect
+    publisher = MqttPublisher(config.mqtt_qos, db_name=config.db_name, table=config.db_table,
+                              cycle_topic=f"tdg/tdf/{config.cell_name}/{config.device_name}/cycle_data",
+                              mark_published=cycle_writer.mark_published,
+                              row_message=lambda row: CycleRecord.from_row(row).message(),
+                              batch_size=config.mqtt_replay_batch, observe=metrics.observe)
+    publisher.start()
+
+    # connects and reconnects in the background, the frame loop never waits for the broker
+    mqtt_connection = MqttConnection(f'{config.cell_name}_{config.device_name}_v1.1', config.mqtt_host, config.mqtt_port,
+                                     config.mqtt_username, config.mqtt_password,
+                                     f'tdg/tdf/{config.cell_name}/{config.device_name}/status', publisher,
+                                     max_delay=mqtt_retry)
+    mqtt_connection.start()
+
+    metrics.counter('reader_dropped_frames', frame_reader.dropped_frames)
+    metrics.counter('snapshots_dropped', lambda: image_sink.dropped)
+    metrics.gauge('db_queue', cycle_writer.queue.qsize)
+    metrics.gauge('mqtt_inflight', lambda: len(publisher.pending))
+    if config.metrics_port:
+        metrics.serve(config.metrics_port, config.metrics_host)
+    if config.metrics_interval:
+        metrics_topic = f"tdg/tdf/{config.cell_name}/{config.device_name}/metrics"
+        metrics.report(lambda message: publisher.publish(metrics_topic, message), config.metrics_interval)
+
+    pipeline = None
+    windows_open = False
+    try:
+        # per camera state (rolling windows, toggles, sums) and buffers live in the pipeline, the services above
+        # were started while the reader process connected to the camera
+        first_frame = read_frame(frame_reader)
+        pipeline = CountingPipeline(config, first_frame, workers=config.pipeline_workers, depth=config.pipeline_depth)
+
+        # started from config.yaml, profiles a number of loop iterations in place
+        profiler = LoopProfiler(name)
+
+        # while the line is stopped only the conveyor box is compared, on one frame every 1/idle_fps seconds with the
+        # stream closed in between, see AdaptiveRate for how late the first cycle after a stop can be
+        rate = AdaptiveRate(0 if config.video else config.idle_after, config.idle_motion)
+        reader_idle = False
+        metrics.gauge('idle', lambda: int(rate.idle))
+
+        font = cv2.FONT_HERSHEY_SIMPLEX
+     
+    
+    
+        while(True):      
+
+            profiler.step()
+            cycle_start_time = time.time()
+            if config_watcher.version != config_version: # reloaded by the watcher thread, no file access here
+                config_version = config_watcher.version
+                config = config_watcher.config
+                pipeline.config = config
+                rate.idle_after = 0 if config.video else config.idle_after # the display needs every frame
+                rate.motion_thresh = config.idle_motion
+                if config.profile_iterations:
+                    profiler.start(config.profile_iterations, config.profile_dir, config.profile_keep)
+
+            idle = rate.idle
+            frame = read_frame(frame_reader, 0 if idle else config.frame_skip)
+            if not idle: # idle frames wait for the idle frame rate
+                metrics.observe('acquire', time.time() - cycle_start_time)
+                metrics.observe('queue_wait', frame_reader.frame_age)
+            height, width = frame.shape[:2]
+ 
+            if config.video == True:
+                frame_org = frame.copy() # overlay text is drawn on frame_org
+            else:
+                frame_org = frame
+
+            ## optical flow and colour signals, converted to a cycle record when a cycle completes
+
+            # run on the pipeline's workers, finished frames come back in submission order
+            if idle:
+                if not rate.idle_after or rate.moved(frame, config): # conveyor moved or idling was switched off
+                    rate.idle = False
+                    pipeline.restart(frame) # flow from this frame on, not across the skipped frames
+                finished = pipeline.drain()
+            else:
+                finished = pipeline.submit(frame_org)
+            for frame_org, cycle in finished:
+                counter = pipeline.counter
+                for stage, seconds in pipeline.stage_times.items(): # gray, flow, signals (colour segmentation), cycle
+                    metrics.observe(stage, seconds)
+                if not rate.idle and rate.update(counter.conv_mean(), counter.time_toggle == 1, cycle_start_time):
+                    logging.info(f"Conveyor still for {rate.idle_after} s, reading {config.idle_fps} frames/s until it moves")
+
+                if cycle is not None:
+                    save_start = time.perf_counter()
+                    save_cycle(config, cycle, frame_org, cycle_writer, image_sink)
+                    publisher.publish_cycle(cycle.db_row())
+                    metrics.observe('save', time.perf_counter() - save_start) # queueing only, the writes are timed in their threads
+    
+                ## Add variables to debug lists
+                if config.setup_mode == True:
+                    record_flow_x.append(pipeline.flow_x)
+                    record_flow_conv.append(pipeline.flow_conv)
+                    record_hsv_1_mag.append(counter.hsv_sum_1)
+                    record_hsv_2_mag.append(counter.hsv_sum_2)
+
+                    if cycle is not None:
+                        perf_record.append({'time':counter.t1, 'cycle_length':cycle.cycle_length, 'part_2':cycle.part_2,'part_1':cycle.part_1, 'ct':cycle.ct})
+
+                ## display video
+
+                if config.video == True:
+
+                    # full frame segmentation is only needed for display, the signals come from the pipeline
+                    reshsv_1 = hsv_segmentation(frame_org, config.HSLlower_1, config.HSLupper_1)
+                    reshsv_2 = hsv_segmentation(frame_org, config.HSLlower, config.HSLupper)
+                    brightness = brightness_thresh(frame_org, config.brightness_thresh)
+                    rgb = pipeline.rgb
+                    
+                    cv2.putText(rgb, f'x_vel {counter.conv_mean():.2f}', (10,height-10), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
+                    cv2.rectangle(rgb, config.ul_bound_flow, config.lr_bound_flow, (255,0,0), (2))
+                    cv2.rectangle(rgb, config.ul_bound_converyor, config.lr_bound_conveyor, (0,0,255), (2))
+                    cv2.imshow("dense optical flow", rgb) 
+
+                    cv2.rectangle(reshsv_1, config.ul_bound_hsv, config.lr_bound_hsv, (0,255,0), (2))
+                    cv2.rectangle(reshsv_2, config.ul_bound_hsv_2, config.lr_bound_hsv_2, (0,0,255), (2))
+                    hsv_image = cv2.addWeighted(reshsv_1,1,reshsv_2,1,0)
+                    cv2.imshow('hsv', hsv_image)
+        
+                    cycle_time = time.time()-cycle_start_time
+                    sample_rate.append(cycle_time)
+                    ave_sample_rate = sample_rate.mean()
+                    cv2.putText(frame_org, f'frame rate {1/ave_sample_rate:.2f}', (10,height-10), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
+                    cv2.imshow(f'frame_org', frame_org)
+
+                    brightness = cv2.cvtColor(brightness, cv2.COLOR_GRAY2BGR)
+                    cv2.rectangle(brightness, config.ul_bound_hsv, config.lr_bound_hsv, (0,255,0), (2))
+                    cv2.imshow('brightness', brightness)
+
+
+            if datetime.fromtimestamp(cycle_start_time).hour == 1 and config.image_dir_cleanup == False:
+                image_directory_cleanup(config)
+            if datetime.fromtimestamp(cycle_start_time).hour == 2 and config.image_dir_cleanup == True:
+                config.image_dir_cleanup == False
+
+
+        
+            # windows are only touched while the video is shown, headless frames go straight to the next read
+            if config.video == True:
+                windows_open = True
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    cv2.destroyAllWindows()
+                    cv2.waitKey(1)
+            elif windows_open: # video switched off on reload
+                windows_open = False
+                cv2.destroyAllWindows()
+                cv2.waitKey(1)
+        
+            if rate.idle != reader_idle:
+                reader_idle = rate.idle
+                frame_reader.set_idle_interval(1 / config.idle_fps if reader_idle and config.idle_fps > 0 else 0)
+            if not idle:
+                metrics.observe('frame', time.time() - cycle_start_time)
+            if heartbeat is not None:
+                heartbeat.value = time.time()
+            if config.stop_running == True or (stop_event is not None and stop_event.is_set()):
+                break
+
+        for frame_org, cycle in pipeline.drain(): # cycles of the frames still in flight
+            if cycle is not None:
+                save_cycle(config, cycle, frame_org, cycle_writer, image_sink)
+                publisher.publish_cycle(cycle.db_row())
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+
+        metrics.close()
+        mqtt_connection.stop()
+        publisher.close()
+        cycle_writer.close()
+        image_sink.close()
+        if notifier:
+            notifier.close()
+        if windows_open:
+            cv2.destroyAllWindows()
+
+def run(config_path="config.yaml"):
+    '''Starts the frame reader first so the camera connects while the writer, MQTT and pipeline are set up'''
+
+    ## config file is watched in the background, the main loop picks up new versions
+    config_watcher = ConfigWatcher(config_path, 0, parse_config, config_default())
+    config_watcher.start()
+    config = config_watcher.config
+
+    # initialise frame reader 
+    frame_reader = rtsp.FrameReader(config.camera_url,
+                                    shared_memory=config.shared_memory,
+                                    max_frame_shape=config.shared_memory_shape,
+                                    decimate=config.reader_decimate,
+                                    target_fps=config.reader_fps,
+                                    scale=config.reader_scale,
+                                    hw_decode=config.reader_hw_decode)
+    frame_reader.start_frame_reader()
+
+    main(config_watcher, frame_reader)
+
+    #cap.release()
+    frame_reader.close()
+    config_watcher.stop()
@@ -0,0 +1,101 @@
+import yaml
+from dataclasses import dataclass, field, fields
+import os
+import logging
+
+
+def get_config(config_path, old_config_mtime, config):
+    '''Checks if config file has been updated and updates config instance of config_default class'''
+    try:
+        mtime = os.path.getmtime(config_path)
+    except Exception as e:
+        logging.error(f"Error getting modification time of config file: {e}")
+        return old_config_mtime, config
+
+    if mtime > old_config_mtime:
+        try:
+            with open(config_path, 'r') as file:
+                configs = list(yaml.safe_load_all(file))
+                if configs:
+                    config = parse_config(configs[0])
+            old_config_mtime = mtime
+        except Exception as e:
+            logging.error(f"Error loading config file: {e}")
+
+    return old_config_mtime, config
+
+
+def parse_config(data):
+    '''Builds a config_default from the counter's yaml document, raises TypeError/ValueError on unknown keys or
+    scalar values of the wrong type so a bad edit is rejected as a whole'''
+    config = config_default(**(data or {}))
+    for f in fields(config):
+        value = getattr(config, f.name)
+        if value is None or f.type not in (bool, int, float, str):
+            continue
+        expected = (int, float) if f.type is float else (bool, int) if f.type is bool else f.type
+        if not isinstance(value, expected) or (f.type is int and isinstance(value, bool)):
+            raise ValueError(f"config {f.name} should be {f.type.__name__}, got {value!r}")
+    return config
+
+
+@dataclass
+class config_default:
+    setup_mode: bool =  False
+    video: bool = True
+    stop_running: bool  = False
+    HSLlower_1: list[int] =  field(default_factory= lambda: [136, 62, 114])
+    HSLupper_1: list[int] =  field(default_factory= lambda: [79, 189, 243])
+    ul_bound_hsv: list[int] =  field(default_factory= lambda: [222,204])
+    lr_bound_hsv: list[int] =  field(default_factory= lambda: [240,270])
+    HSLlower: list[int] =  field(default_factory= lambda:  [13, 23, 244])
+    HSLupper: list[int] =  field(default_factory= lambda:  [35, 255, 255])
+    ul_bound_hsv_2: list[int] =  field(default_factory= lambda: [222,204])
+    lr_bound_hsv_2: list[int] =  field(default_factory= lambda: [240,270])
+    db_name: str =  "disa3.db"
+    db_table: str =  "counts"
+    camera_url: str =  None
+    ul_bound_converyor: list[int] =  field(default_factory= lambda:  [600, 340])
+    lr_bound_conveyor: list[int] =  field(default_factory= lambda:  [630, 360])
+    ul_bound_flow: list[int] =  field(default_factory= lambda:  [90, 180])
+    lr_bound_flow: list[int] =  field(default_factory= lambda: [540, 240])
+    brightness_thresh: int  = 245
+    cell_name: str = "disa3"
+    device_name: str = "optical_counter"
+    mqtt_username: str = ""
+    mqtt_password: str = ""
+    mqtt_host: str = ""
+    mqtt_port: int = 1883
+    image_dir_cleanup: bool  = False
+    flow_roi: bool = True # compute flow on the padded flow/conveyor boxes only when video is off
+    buffer_pool: bool = True # reuse preallocated gray and flow buffers between frames
+    frame_skip: int = 1 # frames read and discarded before each processed frame
+    shared_memory: bool = True # pass frames from the reader process through shared memory instead of a queue
+    shared_memory_shape: list[int] = field(default_factory= lambda: [1080, 1920, 3]) # largest [height, width, channels] frame a shared memory slot holds (after reader_scale), larger frames use the queue
+    reader_decimate: int = 1 # retrieve only every nth camera frame in the reader process (set frame_skip to 0 when used)
+    reader_fps: float = 0 # cap on frames retrieved per second by the reader process, 0 for no cap
+    reader_scale: float = 1.0 # downscale in the reader process, box coordinates are in scaled pixels
+    reader_hw_decode: bool = False # request hardware accelerated decoding from the capture backend
+    image_dir: str = "images" # cycle snapshots are saved here as <id>.jpg
+    db_batch_size: int = 50 # cycle rows per database transaction
+    db_flush_interval: float = 1.0 # longest time in seconds a cycle row waits to be committed
+    image_quality: int = 95 # snapshot JPEG/WebP quality
+    image_scale: float = 1.0 # snapshot resize factor
+    image_roi: list[int] = None # optional [x0, y0, x1, y1] snapshot crop
+    image_format: str = "jpg" # jpg or webp, the processor and dashboard expect jpg
+    image_queue: int = 4 # snapshots waiting to be written before new ones are dropped
+    event_port: int = 47651 # loopback port for cycle notifications to the processor and dashboard, 0 to disable
+    mqtt_qos: dict = field(default_factory= lambda: {'status': 1, 'cycle_data': 1, 'metrics': 0}) # QoS by topic, the last level of the topic
+    mqtt_replay_batch: int = 100 # unpublished cycles sent per batch after a reconnect
+    metrics_port: int = 9108 # Prometheus text endpoint with stage latencies and dropped frames, 0 to disable
+    metrics_host: str = "127.0.0.1" # address the metrics endpoint binds to, 0.0.0.0 for a remote scraper
+    metrics_interval: float = 60 # seconds between messages on the MQTT metrics topic, 0 to disable
+    motion_engine: str = "farneback" # conveyor motion: farneback (dense), lk (sparse Lucas-Kanade) or phase (phase correlation)
+    pipeline_workers: int = 2 # threads running optical flow and colour signals concurrently, 0 runs them in the frame loop
+    pipeline_depth: int = 2 # frames in flight when the flow is headless, 1 finishes each frame before the next is read
+    idle_after: float = 60 # seconds of still conveyor before only the conveyor box is checked at idle_fps, 0 never idles
+    idle_fps: float = 0.5 # frames per second read while idle, the camera stream is closed and nothing decoded in between
+    idle_motion: float = 2.0 # mean gray level change over the conveyor box that returns to full rate
+    profile_iterations: int = 0 # saving config.yaml with this set profiles that many frame loop iterations
+    profile_dir: str = "profiles" # profile runs (.txt, .collapsed) are written here
+    profile_keep: int = 10 # newest profile runs kept in profile_dir
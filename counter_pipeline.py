@@ -0,0 +1,308 @@
+import cv2
+import numpy as np
+import time
+from datetime import datetime, timedelta
+import sqlite3
+from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import logging
+
+from motion import motion_estimator
+from roi_signals import SignalExtractor
+from buffer_pool import BufferPool
+from rolling_window import RollingWindow
+from cycle_schema import create_tables
+
+# Counting pipeline for one camera, shared by casting_counter_1.1.py and counter_supervisor.py.
+# CycleCounter holds the conveyor state machine, CountingPipeline turns frames into signals and cycles,
+# and the functions below read frames and write cycles to the database and image directory.
+
+
+@dataclass
+class CycleRecord:
+    id: int
+    timestamp: float
+    cycle_length: float
+    part_1: bool
+    part_2: bool
+    ct: float
+    box: int
+
+    def db_row(self):
+        return (self.id, self.timestamp, self.cycle_length, self.part_1, self.part_2, self.ct, self.box)
+
+    def message(self):
+        return {'id' : self.id, 'timestamp' : self.timestamp, 'cycle_length' : self.cycle_length,
+                'part_1' : self.part_1, 'part2' : self.part_2, 'ct'  : self.ct, 'box'  : self.box}
+
+    @classmethod
+    def from_row(cls, row):
+        '''CycleRecord from a database row, the part flags are stored as integers'''
+        id, timestamp, cycle_length, part_1, part_2, ct, box = row
+        return cls(id, timestamp, cycle_length, bool(part_1), bool(part_2), ct, box)
+
+
+class CycleCounter:
+    '''Conveyor cycle state machine for one line, fed one frame of signals at a time.
+    A cycle starts when the mean conveyor flow rises above 0.25 and ends when it falls below -0.25.
+    Colour and brightness sums between the two decide which part was made.
+    usage: counter = CycleCounter()
+           cycle = counter.update(flow_x, flow_conv, hsv_1_mean, hsv_2_mean, brightness_1_mean, brightness_2_mean)
+    returns: a CycleRecord when a cycle completes, otherwise None
+    For recorded footage pass start_time and the frame time as now, otherwise the wall clock is used.'''
+
+    hsv_thresh = 10 # cutoff threshold for colour level
+
+    def __init__(self, start_time=None):
+        start_time = start_time or datetime.now()
+        self.conv_window = RollingWindow(5) # conveyor velocity measured over 5 frames
+        self.box_window = RollingWindow(30) # box velocity measured over 30 frames (so that box made flag is carried into database write)
+        self.time_toggle = 0
+        self.hsv_sum_1 = 0
+        self.hsv_sum_2 = 0
+        self.brightness_sum_1 = 0
+        self.brightness_sum_2 = 0
+        self.last_part_1_time = start_time # use to avoid counting missing part 1 as a part 2
+        self.t1 = None
+        self.t1_old = start_time
+        self.ct = timedelta(0)
+
+    def conv_mean(self):
+        return self.conv_window.mean()
+
+    def update(self, flow_x, flow_conv, hsv_1_mean, hsv_2_mean, brightness_1_mean, brightness_2_mean, now=None):
+        now = now or datetime.now()
+
+        self.hsv_sum_1 = min(self.hsv_sum_1 + hsv_1_mean, 300)
+        self.hsv_sum_2 = min(self.hsv_sum_2 + hsv_2_mean, 300)
+        self.brightness_sum_1 = min(self.brightness_sum_1 + brightness_1_mean, 300)
+        self.brightness_sum_2 = min(self.brightness_sum_2 + brightness_2_mean, 300)
+
+        self.conv_window.append(flow_conv)
+        self.box_window.append(flow_x)
+        made_box = 1 if self.box_window.sum() > 10 else 0
+
+        conv_mean = self.conv_mean()
+        if conv_mean > 0.25 and self.time_toggle == 0:
+            self.time_toggle = 1
+            self.t1 = now
+            self.hsv_sum_1 = 0
+            self.hsv_sum_2 = 0
+            self.brightness_sum_1 = 0
+            self.brightness_sum_2 = 0
+        if conv_mean < -0.25 and self.time_toggle == 1:
+            self.time_toggle = 0
+            cycle_length = now - self.t1
+
+            made_part_1 = self.brightness_sum_1 > self.hsv_thresh
+            if made_part_1:
+                self.last_part_1_time = now
+            # avoids double counting man parts as auto
+            made_part_2 = (self.hsv_sum_2 > self.hsv_thresh and not made_part_1
+                           and (now - self.last_part_1_time).total_seconds() >= 300)
+
+            if self.t1_old < self.t1:
+                self.ct = self.t1 - self.t1_old
+                self.t1_old = self.t1
+            return CycleRecord(int(self.t1.timestamp()), self.t1.timestamp(), cycle_length.total_seconds(),
+                               made_part_1, made_part_2, self.ct.total_seconds(), made_box)
+        return None
+
+
+class CountingPipeline:
+    '''Frame to cycle pipeline for one camera: gray conversion, optical flow, colour signals and CycleCounter.
+    Buffers and state persist between frames, config can be replaced between calls when it is reloaded.
+    With workers, optical flow and the colour signals of a frame run concurrently on a thread pool (OpenCV releases
+    the GIL), and submit() keeps up to depth frames in flight, so the flow of one frame overlaps reading the next.
+    Finished frames go through CycleCounter strictly in submission order with their capture time, so the cycles
+    are the same as from process(). Each in flight slot has its own buffers and SignalExtractor.
+    usage: pipeline = CountingPipeline(config, first_frame)
+           cycle = pipeline.process(frame)
+       or: pipeline = CountingPipeline(config, first_frame, workers=2, depth=2)
+           for frame, cycle in pipeline.submit(frame): # zero or more earlier frames, oldest first
+               ...
+           for frame, cycle in pipeline.drain(): ...
+           pipeline.close()
+    After process(), or for each frame yielded by submit(), the per frame signals are available as attributes
+    (flow_x, flow_conv, hsv_1_mean, ...), rgb holds the flow visualisation when it was computed and stage_times the
+    seconds spent in each stage.'''
+
+    def __init__(self, config, first_frame, start_time=None, workers=0, depth=1):
+        self.config = config
+        self.counter = CycleCounter(start_time)
+        self.signal_extractor = SignalExtractor()
+        self.buffers = BufferPool()
+        self.gray_slot = 0
+        self.prev_gray = cv2.cvtColor(first_frame, cv2.COLOR_BGR2GRAY)
+        self.mask = np.zeros_like(first_frame)
+        self.mask[..., 1] = 255
+        self.rgb = None
+        self.stage_times = {'gray': 0.0, 'flow': 0.0, 'signals': 0.0, 'cycle': 0.0}
+        self.depth = max(depth, 1) if workers else 1
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='pipeline') if workers else None
+        self.slot_buffers = [self.buffers] + [BufferPool() for _ in range(self.depth - 1)]
+        self.slot_extractors = [self.signal_extractor] + [SignalExtractor() for _ in range(self.depth - 1)]
+        self.in_flight = deque()
+        self.seq = 0
+        self.motion_engine = None
+        self.estimator = None
+        self.select_engine(config)
+
+    def gray(self, frame):
+        if self.config.buffer_pool == True and self.depth == 1:
+            self.gray_slot ^= 1 # alternate two gray buffers so prev_gray is never overwritten
+            frame_gray = self.buffers.get(f'gray_{self.gray_slot}', frame.shape[:2])
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=frame_gray)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # in flight frames keep their own gray images
+
+    def select_engine(self, config):
+        # config.motion_engine can change on reload, an unknown name keeps the engine in use
+        engine = config.motion_engine
+        if engine == self.motion_engine:
+            return
+        try:
+            self.estimator = motion_estimator(engine)
+        except ValueError as e:
+            logging.error(e)
+            if self.estimator is None:
+                self.estimator = motion_estimator('farneback')
+        self.motion_engine = engine
+
+    def flow(self, estimator, prev_gray, frame_gray, config, buffers):
+        # optical flow for conveyor signal
+        t0 = time.perf_counter()
+        result = estimator.estimate(prev_gray,
+                                    frame_gray,
+                                    self.mask,
+                                    config.ul_bound_flow,
+                                    config.lr_bound_flow,
+                                    config.ul_bound_converyor,
+                                    config.lr_bound_conveyor,
+                                    headless = config.flow_roi and not config.video,
+                                    buffers = buffers if config.buffer_pool else None)
+        return result, time.perf_counter() - t0
+
+    def signals(self, frame, config, extractor):
+        # colour signal for part fill
+        t0 = time.perf_counter()
+        result = extractor.extract(frame, config)
+        return result, time.perf_counter() - t0
+
+    def start(self, frame, now):
+        '''Converts frame to gray and starts its flow and colour signals, on the pool when there are workers'''
+        config = self.config
+        self.select_engine(config)
+        slot = self.seq % self.depth
+        self.seq += 1
+        t0 = time.perf_counter()
+        frame_gray = self.gray(frame)
+        gray_time = time.perf_counter() - t0
+        prev_gray, self.prev_gray = self.prev_gray, frame_gray
+        flow_args = (self.estimator, prev_gray, frame_gray, config, self.slot_buffers[slot])
+        signal_args = (frame, config, self.slot_extractors[slot])
+        if self.executor is None:
+            return frame, now, gray_time, self.flow(*flow_args), self.signals(*signal_args)
+        return (frame, now, gray_time,
+                self.executor.submit(self.flow, *flow_args), self.executor.submit(self.signals, *signal_args))
+
+    def finish(self, started):
+        '''Waits for the flow and colour signals of a started frame and runs CycleCounter, returns (frame, cycle)'''
+        frame, now, gray_time, flow, signals = started
+        if self.executor is not None:
+            flow, signals = flow.result(), signals.result()
+        (self.rgb, self.mask, self.flow_x, self.flow_y, self.flow_conv), flow_time = flow
+        (self.hsv_1_mean, self.hsv_2_mean,
+         self.brightness_1_mean, self.brightness_2_mean), signals_time = signals
+        t0 = time.perf_counter()
+        cycle = self.counter.update(self.flow_x, self.flow_conv,
+                                    self.hsv_1_mean, self.hsv_2_mean,
+                                    self.brightness_1_mean, self.brightness_2_mean, now)
+        stage_times = self.stage_times
+        stage_times['gray'] = gray_time
+        stage_times['flow'] = flow_time
+        stage_times['signals'] = signals_time
+        stage_times['cycle'] = time.perf_counter() - t0
+        return frame, cycle
+
+    def restart(self, frame):
+        '''Starts the flow again from frame after frames were skipped, only while no frames are in flight'''
+        self.prev_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.estimator.reset()
+
+    def process(self, frame, now=None):
+        '''Runs one frame through all stages and returns its cycle, only used while no frames are in flight'''
+        frame, cycle = self.finish(self.start(frame, now))
+        return cycle
+
+    def submit(self, frame, now=None):
+        '''Starts frame and yields (frame, cycle) for the frames that finished, in submission order.
+        Only depth frames are kept in flight while the headless flow is used, the flow visualisation draws into one
+        shared mask, and an engine that tracks points from frame to frame (MotionEstimator.sequential) gets one
+        frame at a time. Frames kept in flight are copied, a shared memory frame is only valid until the next read,
+        a frame finished before submit returns is used as it is.'''
+        self.select_engine(self.config)
+        depth = self.in_flight_depth()
+        if depth > 1:
+            frame = frame.copy()
+        self.in_flight.append(self.start(frame, now or datetime.now()))
+        while len(self.in_flight) > depth - 1:
+            yield self.finish(self.in_flight.popleft())
+
+    def in_flight_depth(self):
+        '''Frames submit() keeps in flight with the current config and engine'''
+        config = self.config
+        return self.depth if config.flow_roi and not config.video and not self.estimator.sequential else 1
+
+    def drain(self):
+        '''Yields (frame, cycle) for the frames still in flight'''
+        while self.in_flight:
+            yield self.finish(self.in_flight.popleft())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def read_frame(frame_reader, frame_skip=0):
+    '''Reads frame_skip + 1 frames and returns the last, restarting the frame reader until a frame arrives'''
+    frame = None
+    while frame is None:
+        try:
+            for _ in range(frame_skip + 1):
+                frame = frame_reader.get_frame()
+                if frame is None:
+                    raise ValueError("Frame is None")
+            break
+        except:
+            logging.error("failed to capture frame from camera")
+            frame_reader.stop_frame_reader()
+            time.sleep(5)
+            frame_reader.start_frame_reader()
+    return frame
+
+
+def create_table(config):
+    '''check database exists and create if required'''
+    con = sqlite3.connect(config.db_name)
+    create_tables(con, config.db_table)
+    con.close()
+
+
+def save_cycle(config, cycle, frame, cycle_writer=None, image_sink=None):
+    '''Saves the cycle snapshot and writes the cycle row to the database, through image_sink and cycle_writer when given'''
+    if image_sink is not None:
+        image_sink.save(cycle.id, frame)
+    else:
+        cv2.imwrite(os.path.join(config.image_dir, f'{cycle.id}.jpg'), frame)
+
+    if cycle_writer is not None:
+        cycle_writer.write(cycle.db_row())
+        return
+    con = sqlite3.connect(f"{config.db_name}")
+    cur = con.cursor()
+    data_string = f"INSERT OR REPLACE INTO {config.db_table}(id, timestamp, track_cycle, part_1, part_2, ct, sent) VALUES (?,?,?,?,?,?,?)"
+    cur.execute(data_string, cycle.db_row())
+    con.commit()
+    con.close()
@@ -0,0 +1,216 @@
+import manageRTSP as rtsp
+from counter_config import config_default, parse_config
+from config_watcher import ConfigWatcher
+import counter_app
+import cv2
+import multiprocessing
+import signal
+import time
+import yaml
+from dataclasses import dataclass
+import os
+import sys
+import logging
+
+# Runs several optical counters from one process tree instead of one casting_counter per line.
+# Each camera gets its own worker process with a FrameReader and counter_app's frame loop (pipeline workers, idle
+# rate, metrics, profiling and config reloads as for a single camera), the supervisor watches a heartbeat per
+# worker and restarts workers that exit or stop processing frames.
+# usage: python counter_supervisor.py [cameras.yaml]
+#
+# cameras.yaml:
+#   supervisor:            # optional, fields of supervisor_default
+#     heartbeat_timeout: 60
+#   defaults:              # optional, config_default fields shared by all cameras
+#     mqtt_host: 127.0.0.1
+#   cameras:               # one entry per line, config_default fields
+#     - cell_name: disa3
+#       camera_url: rtsp://...
+#       db_name: disa3.db
+#       image_dir: images/disa3
+#
+# Cameras without their own event_port or metrics_port get the defaults' (or config_default's) port plus their index
+# in the list, 47651, 47652, ..., the processor and dashboard of each line listen on its camera's event port.
+# video is off unless it is set, the windows of several cameras would share their names.
+# Each worker watches cameras.yaml and applies changes to its camera's entry (and the defaults) like counter_app
+# does for config.yaml. Adding, removing or reordering cameras needs a restart of the supervisor.
+
+
+@dataclass
+class supervisor_default:
+    heartbeat_timeout: float = 60 # seconds without a processed frame before a worker is restarted
+    check_interval: float = 5 # seconds between health checks
+    restart_delay: float = 5 # seconds to wait before restarting a worker
+    stop_timeout: float = 10 # seconds a worker gets to shut down cleanly before it is terminated
+    cv_threads: int = 1 # OpenCV threads per worker, bounds CPU use per camera
+    mqtt_retry: float = 30 # longest delay in seconds between MQTT reconnect attempts in a worker
+
+
+def parse_cameras(data):
+    '''Returns supervisor settings and a list of config_default keyword dicts from the cameras.yaml document.
+    Raises ValueError when two cameras would bind the same event_port or metrics_port'''
+    settings = supervisor_default(**(data.get('supervisor') or {}))
+    defaults = data.get('defaults') or {}
+    cameras = [{'video': False, **defaults, **camera} for camera in data.get('cameras') or []]
+    for key in ('event_port', 'metrics_port'):
+        # only one camera can bind a port, the others would fall back (event_port) or serve nothing (metrics_port)
+        base_port = defaults.get(key, getattr(config_default, key))
+        for i, camera in enumerate(cameras):
+            camera[key] = camera.get(key, base_port + i if base_port else 0)
+        ports = [camera[key] for camera in cameras if camera[key]]
+        duplicates = sorted({port for port in ports if ports.count(port) > 1})
+        if duplicates:
+            raise ValueError(f"{key} {', '.join(map(str, duplicates))} is used by more than one camera")
+    for camera in cameras:
+        parse_config(camera) # fail here on unknown keys rather than in a restart loop
+    return settings, cameras
+
+
+def load_cameras(path):
+    '''Reads the camera list, returns supervisor settings and a list of config_default keyword dicts'''
+    with open(path, 'r') as file:
+        data = yaml.safe_load(file) or {}
+    return parse_cameras(data)
+
+
+def camera_parser(index, cell_name):
+    '''parse function for a ConfigWatcher on cameras.yaml, returns the config of camera index'''
+    def parse(data):
+        _, cameras = parse_cameras(data)
+        if index >= len(cameras) or cameras[index].get('cell_name') != cell_name:
+            raise ValueError(f"camera {index} is no longer {cell_name}, restart the supervisor to add, remove or reorder cameras")
+        return parse_config(cameras[index])
+    return parse
+
+
+def run_camera(cameras_path, index, camera, settings, heartbeat, stop_event):
+    '''Worker process: counter_app's frame loop for one camera. Updates heartbeat after every processed frame'''
+    config = parse_config(camera)
+    logging.basicConfig(filename=f'app_counter_{config.cell_name}.log',
+                        level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        filemode='a',
+                        force=True)
+    logging.debug(f'{config.cell_name} worker started')
+    cv2.setNumThreads(settings.cv_threads)
+    # turn terminate() into a normal exit so the services, frame reader process and shared memory are released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    os.makedirs(config.image_dir, exist_ok=True)
+
+    config_watcher = ConfigWatcher(cameras_path, 0, camera_parser(index, camera.get('cell_name')), config)
+    config_watcher.start()
+    config = config_watcher.config # the file may have changed since the supervisor read it
+    frame_reader = rtsp.FrameReader(config.camera_url,
+                                    shared_memory=config.shared_memory,
+                                    max_frame_shape=config.shared_memory_shape,
+                                    decimate=config.reader_decimate,
+                                    target_fps=config.reader_fps,
+                                    scale=config.reader_scale,
+                                    hw_decode=config.reader_hw_decode)
+    try:
+        frame_reader.start_frame_reader()
+        counter_app.main(config_watcher, frame_reader, name=f'counter_{config.cell_name}',
+                         stop_event=stop_event, heartbeat=heartbeat, mqtt_retry=settings.mqtt_retry)
+    finally:
+        frame_reader.close()
+        config_watcher.stop()
+        logging.debug(f'{config.cell_name} worker stopped')
+
+
+class CounterSupervisor:
+    '''Starts one worker process per camera and keeps them running.
+    A worker is restarted when its process exits or when its heartbeat (time of the last processed frame)
+    is older than heartbeat_timeout. Per camera state lives in the worker's CountingPipeline.
+    usage: settings, cameras = load_cameras('cameras.yaml')
+           CounterSupervisor('cameras.yaml', cameras, settings).run()
+    args: cameras_path: str: cameras.yaml, watched by the workers for config changes
+          cameras: list: config_default keyword dicts from load_cameras
+          settings: supervisor_default: health check and worker settings'''
+
+    def __init__(self, cameras_path, cameras, settings=None):
+        self.cameras_path = cameras_path
+        self.cameras = cameras
+        self.settings = settings or supervisor_default()
+        self.stop_event = multiprocessing.Event()
+        self.processes = [None] * len(cameras)
+        self.heartbeats = [multiprocessing.Value('d', 0.0) for _ in cameras]
+        self.restarts = [0] * len(cameras)
+
+    def name(self, i):
+        return self.cameras[i].get('cell_name', str(i))
+
+    def start_camera(self, i):
+        self.heartbeats[i].value = time.time() # grace period for connecting to the camera
+        process = multiprocessing.Process(target=run_camera,
+                                          args=(self.cameras_path, i, self.cameras[i], self.settings,
+                                                self.heartbeats[i], self.stop_event),
+                                          name=f'counter_{self.name(i)}')
+        process.start()
+        self.processes[i] = process
+        logging.info(f'Started counter for {self.name(i)} (pid {process.pid})')
+
+    def stop_camera(self, i):
+        process = self.processes[i]
+        if process is None:
+            return
+        if process.is_alive():
+            process.terminate()
+            process.join(self.settings.stop_timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        self.processes[i] = None
+
+    def check(self):
+        '''Health check, restarts workers that have exited or stalled'''
+        now = time.time()
+        for i, process in enumerate(self.processes):
+            if process is not None and process.is_alive() and now - self.heartbeats[i].value <= self.settings.heartbeat_timeout:
+                continue
+            if process is not None and process.is_alive():
+                logging.error(f'Counter for {self.name(i)} stalled for {now - self.heartbeats[i].value:.0f} s, restarting')
+            else:
+                logging.error(f'Counter for {self.name(i)} not running, restarting')
+            self.stop_camera(i)
+            time.sleep(self.settings.restart_delay)
+            self.restarts[i] += 1
+            self.start_camera(i)
+
+    def status(self):
+        now = time.time()
+        return {self.name(i): {'alive': process is not None and process.is_alive(),
+                               'heartbeat_age': now - self.heartbeats[i].value,
+                               'restarts': self.restarts[i]}
+                for i, process in enumerate(self.processes)}
+
+    def stop(self):
+        self.stop_event.set()
+        for i, process in enumerate(self.processes):
+            if process is not None:
+                process.join(self.settings.stop_timeout)
+            self.stop_camera(i)
+
+    def run(self):
+        for i in range(len(self.cameras)):
+            self.start_camera(i)
+        try:
+            while True:
+                time.sleep(self.settings.check_interval)
+                self.check()
+        finally:
+            self.stop()
+
+
+if __name__ == '__main__':
+
+    ## set up logging
+    logging.basicConfig(filename='app_supervisor.log',
+                        level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        filemode='a')
+    logging.debug('log started')
+
+    cameras_path = sys.argv[1] if len(sys.argv) > 1 else "cameras.yaml"
+    settings, cameras = load_cameras(cameras_path)
+    supervisor = CounterSupervisor(cameras_path, cameras, settings)
+    supervisor.run()
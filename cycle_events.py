@@ -0,0 +1,133 @@
+import socket
+import threading
+import json
+import logging
+from collections import deque
+
+# Local event channel from the counter to the processor and dashboard, so they wake when a cycle row is
+# committed instead of polling the database. The counter runs a CycleNotifier on a loopback TCP port
+# (works on Windows, unlike Unix domain sockets) and sends one JSON line per committed cycle row.
+# Consumers use a CycleListener and fall back to their polling interval when the counter is not running.
+
+
+class CycleNotifier:
+    '''Publishes cycle events to any number of local CycleListeners.
+    Slow or closed listeners are dropped, publishing never blocks for longer than send_timeout.
+    usage: notifier = CycleNotifier(config.event_port)
+           notifier.start()
+           writer = CycleWriter(..., on_commit=notifier.publish_rows)
+    args: port: int: loopback port to listen on
+          host: str: address to bind, keep to loopback
+          send_timeout: float: seconds a send to one listener may take before it is dropped'''
+
+    def __init__(self, port, host='127.0.0.1', send_timeout=0.2):
+        self.port = port
+        self.host = host
+        self.send_timeout = send_timeout
+        self.clients = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        try:
+            self.server = socket.create_server((self.host, self.port))
+        except OSError as e:
+            logging.error(f"Cycle event port {self.port} unavailable, consumers will poll: {e}")
+            return False
+        self.thread = threading.Thread(target=self.accept, name='cycle_notifier', daemon=True)
+        self.thread.start()
+        return True
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:
+                break # server closed
+            client.settimeout(self.send_timeout)
+            with self.lock:
+                self.clients.append(client)
+
+    def publish(self, event):
+        line = (json.dumps(event) + '\n').encode()
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.sendall(line)
+                except OSError:
+                    client.close()
+                    self.clients.remove(client)
+
+    def publish_rows(self, rows):
+        '''CycleWriter on_commit callback, one event per committed row'''
+        for row in rows:
+            self.publish({'id': row[0], 'timestamp': row[1]})
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.shutdown(socket.SHUT_RDWR) # wakes the accept thread so the port is released
+            except OSError:
+                pass
+            self.server.close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients.clear()
+
+
+class CycleListener:
+    '''Receives cycle events from a CycleNotifier, reconnecting in the background while the counter is down.
+    usage: listener = CycleListener(port)
+           listener.start()
+           if listener.wait(timeout): # a cycle was committed
+    args: port: int: loopback port of the CycleNotifier
+          host: str: address of the counter
+          retry: float: seconds between connection attempts'''
+
+    def __init__(self, port, host='127.0.0.1', retry=5):
+        self.port = port
+        self.host = host
+        self.retry = retry
+        self.condition = threading.Condition()
+        self.received = 0 # cycle events received, wait() returns when this passes what it last saw
+        self.seen = 0
+        self.events = deque(maxlen=100)
+        self.connected = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cycle_listener', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=self.retry) as connection:
+                    connection.settimeout(None)
+                    self.connected = True
+                    for line in connection.makefile('r'):
+                        try:
+                            self.events.append(json.loads(line))
+                        except ValueError:
+                            continue
+                        with self.condition:
+                            self.received += 1
+                            self.condition.notify_all()
+            except OSError:
+                pass
+            self.connected = False
+            self.stop_event.wait(self.retry)
+
+    def wait(self, timeout):
+        '''Blocks until a cycle event arrives or timeout seconds pass, returns True if a cycle arrived.
+        Events that arrive while the caller reads the database make the next wait return at once, none are lost'''
+        with self.condition:
+            arrived = self.condition.wait_for(lambda: self.received != self.seen, timeout)
+            self.seen = self.received
+        return arrived
+
+    def close(self):
+        self.stop_event.set()
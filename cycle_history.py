@@ -0,0 +1,142 @@
+import sqlite3
+import datetime
+import os
+import argparse
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+from kpi_engine import KpiEngine, COLUMNS
+
+# Columnar history of closed days of cycles, for week, month and trend queries without scanning SQLite.
+# One Parquet file per production day (04:00 to 04:00 local time, as the processor's day) in history_dir,
+# named YYYY-MM-DD.parquet, typed as SCHEMA. Days are exported once they are closed, from the live and archive
+# tables of cycle_schema, and files are read memory mapped.
+# usage: python cycle_history.py disa3.db counter --history-dir history
+#        engine = history_engine(start, end)
+#        trend = daily_trend(datetime.date(2024, 1, 1), datetime.date(2024, 2, 1))
+
+SCHEMA = pa.schema([('id', pa.int64()),
+                    ('timestamp', pa.float64()),
+                    ('track_cycle', pa.float64()),
+                    ('part_1', pa.int8()),
+                    ('part_2', pa.int8()),
+                    ('ct', pa.float64()),
+                    ('sent', pa.int8())])
+
+DAY_START = datetime.time(4, 0)
+
+
+def day_start(date):
+    '''Epoch seconds of the start of a production day, local time'''
+    return datetime.datetime.combine(date, DAY_START).timestamp()
+
+
+def production_date(timestamp):
+    return (datetime.datetime.fromtimestamp(timestamp) - datetime.timedelta(hours=DAY_START.hour,
+                                                                             minutes=DAY_START.minute)).date()
+
+
+def day_path(history_dir, date):
+    return os.path.join(history_dir, f'{date.isoformat()}.parquet')
+
+
+def exported_dates(history_dir):
+    dates = []
+    if os.path.isdir(history_dir):
+        for name in os.listdir(history_dir):
+            try:
+                dates.append(datetime.date.fromisoformat(name.removesuffix('.parquet')))
+            except ValueError:
+                continue
+    return sorted(dates)
+
+
+def export_days(db_name, table='counter', history_dir='history', until=None):
+    '''Writes a file for every closed day after the last exported one, up to but not including until
+    (default the current production day). Returns the dates written'''
+    until = until or production_date(datetime.datetime.now().timestamp())
+    os.makedirs(history_dir, exist_ok=True)
+    con = sqlite3.connect(db_name, timeout=30)
+    tables = [t for t in (f'{table}_archive', table)
+              if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (t,)).fetchone()]
+    if not tables:
+        con.close()
+        return []
+    source = ' UNION ALL '.join(f'SELECT {COLUMNS} FROM {t} WHERE id >= ? AND id < ?' for t in tables)
+    try:
+        done = exported_dates(history_dir)
+        if done:
+            date = done[-1] + datetime.timedelta(days=1)
+        else:
+            firsts = [con.execute(f'SELECT min(id) FROM {t}').fetchone()[0] for t in tables]
+            firsts = [first for first in firsts if first is not None]
+            if not firsts:
+                return [] # nothing recorded yet
+            date = production_date(min(firsts))
+
+        written = []
+        while date < until:
+            bounds = (day_start(date), day_start(date + datetime.timedelta(days=1)))
+            rows = con.execute(f'{source} ORDER BY id', bounds * len(tables)).fetchall()
+            columns = list(zip(*rows)) if rows else [[] for _ in SCHEMA]
+            day = pa.table([pa.array(column, type=field.type) for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+            path = day_path(history_dir, date)
+            pq.write_table(day, path + '.tmp', compression='zstd')
+            os.replace(path + '.tmp', path) # a reader never sees a half written day
+            written.append(date)
+            date += datetime.timedelta(days=1)
+        if written:
+            logging.info(f"Exported {len(written)} days of {table} to {history_dir}")
+        return written
+    finally:
+        con.close()
+
+
+def read_history(start, end=None, history_dir='history', columns=None):
+    '''Cycles with start <= id < end (epoch seconds) from the exported days, as a pyarrow Table'''
+    first = production_date(start)
+    last = production_date(end) if end is not None else datetime.date.max
+    tables = []
+    for date in exported_dates(history_dir):
+        if first <= date <= last:
+            tables.append(pq.read_table(day_path(history_dir, date), columns=columns, memory_map=True))
+    if not tables:
+        schema = SCHEMA if columns is None else pa.schema([SCHEMA.field(c) for c in columns])
+        return schema.empty_table()
+    history = pa.concat_tables(tables)
+    mask = pc.greater_equal(history['id'], start)
+    if end is not None:
+        mask = pc.and_(mask, pc.less(history['id'], end))
+    return history.filter(mask)
+
+
+def history_engine(start, end=None, history_dir='history', table='counter'):
+    '''KpiEngine loaded with the exported cycles with start <= id < end, for KPIs over weeks or months'''
+    history = read_history(start, end, history_dir)
+    engine = KpiEngine(table, capacity=max(len(history), 1))
+    engine.start_time = start
+    engine.extend(np.column_stack([history[name].to_numpy(zero_copy_only=False).astype(float) for name in SCHEMA.names]))
+    return engine
+
+
+def daily_trend(first, last, history_dir='history'):
+    '''Totals per production day from first to last (dates, inclusive), with the processor's daily rules.
+    Returns a dict of numpy arrays, one value per day, and 'date' '''
+    dates = [first + datetime.timedelta(days=i) for i in range((last - first).days + 2)]
+    edges = [day_start(date) for date in dates]
+    engine = history_engine(edges[0], edges[-1], history_dir)
+    trend = engine.windows(edges, exclude_first=True)
+    trend['date'] = np.array(dates[:-1])
+    return trend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export closed days of cycles to Parquet')
+    parser.add_argument('db_name')
+    parser.add_argument('table', nargs='?', default='counter')
+    parser.add_argument('--history-dir', default='history')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(export_days(args.db_name, args.table, args.history_dir))
@@ -0,0 +1,143 @@
+import sqlite3
+import time
+import argparse
+import logging
+
+# Schema, migration and retention for the cycle table written by the counter.
+#   <table>           typed cycle rows, id is the cycle start in epoch seconds (rowid, so id ranges are index scans)
+#   <table>_archive   same columns, rows older than the retention period are moved here
+#   <table>_hourly    one row per hour, pre-aggregated with the processor's rules (ct2 > 7 s, track_cycle < 10,
+#                     running when less than 45 s after the previous cycle)
+#   schema_version    migration version per table
+# published is 0 until the broker has acknowledged the row's cycle_data message (mqtt_publisher.py), rows from
+# before version 2 are taken as published. sent is the box made flag, as written by the counter.
+# The live table then only holds recent cycles, so reads for today and the current shift stay the same size
+# however many years of data the database holds.
+# usage: python cycle_schema.py disa3.db counter --keep-days 90
+
+SCHEMA_VERSION = 2
+
+COLUMNS = "id, timestamp, track_cycle, part_1, part_2, ct, sent"
+
+
+def table_sql(table):
+    return (f"CREATE TABLE IF NOT EXISTS {table}(id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, "
+            f"track_cycle REAL, part_1 INTEGER, part_2 INTEGER, ct REAL, sent INTEGER DEFAULT 0, published INTEGER DEFAULT 0)")
+
+
+def get_version(con, table):
+    con.execute("CREATE TABLE IF NOT EXISTS schema_version(table_name TEXT PRIMARY KEY, version INTEGER)")
+    row = con.execute("SELECT version FROM schema_version WHERE table_name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+
+def table_exists(con, table):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def create_tables(con, table):
+    '''Creates or migrates the cycle, archive and hourly tables to SCHEMA_VERSION. Safe to call on every start'''
+    if get_version(con, table) >= SCHEMA_VERSION and table_exists(con, table):
+        return
+    with con: # one transaction, readers see either the old or the new table
+        if table_exists(con, table) and get_version(con, table) < 1:
+            # untyped table from before the schema module, rebuild it with typed columns
+            logging.info(f"Migrating {table} to typed columns")
+            con.execute(f"DROP TABLE IF EXISTS {table}_migrate")
+            con.execute(table_sql(f"{table}_migrate"))
+            con.execute(f"INSERT INTO {table}_migrate({COLUMNS}) SELECT id, CAST(timestamp AS REAL), CAST(track_cycle AS REAL), "
+                        f"CAST(part_1 AS INTEGER), CAST(part_2 AS INTEGER), CAST(ct AS REAL), CAST(sent AS INTEGER) "
+                        f"FROM {table} WHERE timestamp IS NOT NULL")
+            con.execute(f"DROP TABLE {table}")
+            con.execute(f"ALTER TABLE {table}_migrate RENAME TO {table}")
+        con.execute(table_sql(table))
+        con.execute(f"CREATE INDEX IF NOT EXISTS {table}_timestamp_idx ON {table}(timestamp)")
+        con.execute(table_sql(f"{table}_archive"))
+        if get_version(con, table) < 2:
+            # rows written before publishing was tracked are not replayed
+            for name in (table, f"{table}_archive"):
+                if 'published' not in [column[1] for column in con.execute(f"PRAGMA table_info({name})")]:
+                    con.execute(f"ALTER TABLE {name} ADD COLUMN published INTEGER DEFAULT 0")
+                con.execute(f"UPDATE {name} SET published = 1")
+        con.execute(f"CREATE INDEX IF NOT EXISTS {table}_unpublished_idx ON {table}(id) WHERE published = 0")
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table}_hourly(hour INTEGER PRIMARY KEY, cycles INTEGER, "
+                    f"counted_cycles INTEGER, part_1 INTEGER, part_2 INTEGER, running_time REAL, stopped_time REAL, "
+                    f"boxes INTEGER)")
+        con.execute("INSERT OR REPLACE INTO schema_version(table_name, version) VALUES (?, ?)", (table, SCHEMA_VERSION))
+
+
+def rollup(con, table, since=None):
+    '''Recomputes the hourly rollup for every hour from since (epoch seconds, default the latest rolled up hour)'''
+    if since is None:
+        row = con.execute(f"SELECT max(hour) FROM {table}_hourly").fetchone()
+        since = row[0] or 0
+    since = int(since // 3600 * 3600)
+    source = f"SELECT {COLUMNS} FROM {table}_archive UNION ALL SELECT {COLUMNS} FROM {table}"
+    with con:
+        # the cycle before the first hour is included so its successor gets the right gap
+        con.execute(f"""
+            INSERT OR REPLACE INTO {table}_hourly(hour, cycles, counted_cycles, part_1, part_2, running_time, stopped_time, boxes)
+            SELECT CAST(timestamp / 3600 AS INTEGER) * 3600 AS hour,
+                   count(*),
+                   sum(counted),
+                   sum(CASE WHEN counted THEN part_1 ELSE 0 END),
+                   sum(CASE WHEN counted THEN part_2 ELSE 0 END),
+                   sum(CASE WHEN counted AND gap < 45 THEN ct ELSE 0 END),
+                   sum(CASE WHEN counted AND (gap IS NULL OR gap >= 45) THEN ct ELSE 0 END),
+                   sum(CASE WHEN counted THEN sent ELSE 0 END)
+            FROM (SELECT *, (gap > 7 AND track_cycle < 10) AS counted
+                  FROM (SELECT *, timestamp - lag(timestamp) OVER (ORDER BY id) AS gap
+                        FROM ({source})
+                        WHERE id >= coalesce((SELECT max(id) FROM ({source}) WHERE id < ?), ?)))
+            WHERE id >= ?
+            GROUP BY hour""", (since, since, since))
+
+
+def archive(con, table, keep_days, now=None):
+    '''Moves cycles older than keep_days from the live table to the archive table, returns the number moved'''
+    cutoff = (now or time.time()) - keep_days * 86400
+    with con:
+        con.execute(f"INSERT OR REPLACE INTO {table}_archive({COLUMNS}, published) SELECT {COLUMNS}, published FROM {table} WHERE id < ?", (cutoff,))
+        moved = con.execute(f"DELETE FROM {table} WHERE id < ?", (cutoff,)).rowcount
+    return moved
+
+
+def purge_archive(con, table, archive_days, now=None):
+    '''Deletes archived cycles older than archive_days, the hourly rollup keeps their totals'''
+    cutoff = (now or time.time()) - archive_days * 86400
+    with con:
+        return con.execute(f"DELETE FROM {table}_archive WHERE id < ?", (cutoff,)).rowcount
+
+
+def compact(con, vacuum=False):
+    con.execute("PRAGMA optimize")
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    if vacuum:
+        con.execute("VACUUM")
+
+
+def maintenance(db_name, table, keep_days=90, archive_days=None, vacuum=False):
+    '''Retention and compaction job: migrate, roll up new hours, archive old cycles, optionally purge and vacuum'''
+    con = sqlite3.connect(db_name, timeout=30)
+    try:
+        create_tables(con, table)
+        rollup(con, table)
+        moved = archive(con, table, keep_days) if keep_days else 0
+        purged = purge_archive(con, table, archive_days) if archive_days else 0
+        compact(con, vacuum)
+        logging.info(f"Maintenance of {table}: {moved} cycles archived, {purged} archived cycles purged")
+        return moved, purged
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate, roll up and archive the cycle table')
+    parser.add_argument('db_name')
+    parser.add_argument('table', nargs='?', default='counter')
+    parser.add_argument('--keep-days', type=int, default=90, help='days of cycles kept in the live table, 0 keeps all')
+    parser.add_argument('--archive-days', type=int, default=None, help='days of cycles kept in the archive table')
+    parser.add_argument('--vacuum', action='store_true', help='rebuild the database file to release free pages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(maintenance(args.db_name, args.table, args.keep_days, args.archive_days, args.vacuum))
@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+import queue
+import time
+import logging
+from cycle_schema import create_tables
+
+
+class CycleWriter:
+    '''Writes cycle rows to SQLite from a background thread so the frame loop never waits on disk.
+    One connection is kept open in WAL mode. Rows are taken from a queue and committed in batches,
+    when batch_size rows are waiting or flush_interval seconds after the first waiting row.
+    A failed commit keeps its rows and retries on the next flush, close() flushes what is left.
+    Cycle ids acknowledged by the MQTT broker are marked published in the same transactions (mark_published).
+    usage: writer = CycleWriter(config.db_name, config.db_table)
+           writer.start()
+           writer.write(cycle.db_row())
+           writer.close()
+    args: db_name: str: SQLite database file
+          db_table: str: table for the cycle rows, created or migrated by cycle_schema if required
+          batch_size: int: rows per transaction before a flush is forced
+          flush_interval: float: longest time in seconds a row waits before it is committed
+          on_commit: callable: called from the writer thread with the rows of each successful commit
+          observe: callable: called with ('db_write', seconds) for each transaction, e.g. Metrics.observe'''
+
+    def __init__(self, db_name, db_table, batch_size=50, flush_interval=1.0, on_commit=None, observe=None):
+        self.db_name = db_name
+        self.db_table = db_table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_commit = on_commit
+        self.observe = observe
+        self.queue = queue.Queue()
+        self.published = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cycle_writer', daemon=True)
+        self.thread.start()
+
+    def write(self, row):
+        '''Queues a (id, timestamp, track_cycle, part_1, part_2, ct, sent) row, never blocks'''
+        self.queue.put_nowait(row)
+
+    def mark_published(self, ids):
+        '''Queues cycle ids whose MQTT message was acknowledged, never blocks'''
+        for id in ids:
+            self.published.put_nowait(id)
+
+    def connect(self):
+        con = sqlite3.connect(self.db_name)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent, commits skip the fsync
+        create_tables(con, self.db_table)
+        return con
+
+    def flush(self, con, rows):
+        # rows are queued before their message is published, so every acknowledged row is inserted first
+        while not self.queue.empty():
+            rows.append(self.queue.get_nowait())
+        published = []
+        while not self.published.empty():
+            published.append((self.published.get_nowait(),))
+        start = time.perf_counter()
+        try:
+            con.executemany(f"INSERT OR REPLACE INTO {self.db_table}(id, timestamp, track_cycle, part_1, part_2, ct, sent) VALUES (?,?,?,?,?,?,?)", rows)
+            con.executemany(f"UPDATE {self.db_table} SET published = 1 WHERE id = ?", published)
+            con.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Error writing {len(rows)} cycle rows, will retry: {e}")
+            try:
+                con.rollback()
+            except sqlite3.Error:
+                pass
+            for id, in published:
+                self.published.put_nowait(id)
+            return rows
+        if self.observe is not None:
+            self.observe('db_write', time.perf_counter() - start)
+        if self.on_commit is not None:
+            try:
+                self.on_commit(rows)
+            except Exception as e:
+                logging.error(f"Error in cycle commit callback: {e}")
+        return []
+
+    def run(self):
+        con = self.connect()
+        rows = []
+        first_row_time = None
+        try:
+            while not (self.stop_event.is_set() and self.queue.empty()):
+                timeout = self.flush_interval if first_row_time is None else max(first_row_time + self.flush_interval - time.time(), 0)
+                try:
+                    rows.append(self.queue.get(timeout=timeout))
+                    if first_row_time is None:
+                        first_row_time = time.time()
+                except queue.Empty:
+                    pass
+                if rows and (len(rows) >= self.batch_size or time.time() - first_row_time >= self.flush_interval):
+                    rows = self.flush(con, rows)
+                    first_row_time = time.time() if rows else None
+                elif not rows and not self.published.empty():
+                    rows = self.flush(con, rows)
+                    first_row_time = time.time() if rows else None
+            if rows or not self.queue.empty() or not self.published.empty():
+                rows = self.flush(con, rows)
+            if rows:
+                logging.error(f"{len(rows)} cycle rows could not be written at shutdown: {rows}")
+        finally:
+            con.close()
+
+    def close(self, timeout=10):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+import datetime
+import logging
+import pandas as pd
+import pytz
+from cycle_events import CycleListener
+from kpi_engine import KpiEngine
+
+
+class DashboardData:
+    '''Dashboard figures for the day since 04:30, kept up to date by one background thread for every session.
+    Only rows newer than the last seen id are read, woken by the counter's cycle events (or every idle_poll
+    seconds when the counter is not reachable), and appended to a KpiEngine, which gives the totals, first
+    cycle/box/pour times and 10 minute rolling rates with the same rules as the processor. Gives the same
+    figures as the per session pandas code it replaces in streamlit_app_v1.py, which skipped the first row of the day.
+    Sessions read the latest snapshot, a dict that is replaced (never changed) on every update.
+    usage: data = DashboardData('disa3v1.db')
+           data.start()
+           snapshot = data.wait(version, 0.5)
+    args: db_name: str: SQLite database file
+          table: str: table holding the cycle rows
+          event_port: int: counter's cycle notification port, 0 to poll every idle_poll seconds
+          idle_poll: float: longest time in seconds between database reads
+          day_start: tuple: (hour, minute) the day starts at, local time'''
+
+    def __init__(self, db_name, table='counter', event_port=47651, idle_poll=30, day_start=(4, 30)):
+        self.db_name = db_name
+        self.table = table
+        self.idle_poll = idle_poll
+        self.day_start = day_start
+        self.lon = pytz.timezone("Europe/London")
+        self.listener = CycleListener(event_port)
+        self.event_port = event_port
+        self.condition = threading.Condition()
+        self.snapshot = None
+        self.version = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.engine = KpiEngine(table)
+
+    def update(self, con):
+        '''Reads rows newer than the last seen id, returns the number of new rows'''
+        current_time = datetime.datetime.now(self.lon)
+        target_date = datetime.datetime(year = current_time.year,
+                                        month = current_time.month,
+                                        day = current_time.day,
+                                        hour = self.day_start[0],
+                                        minute = self.day_start[1]).timestamp()
+        changed = target_date != self.engine.start_time
+        new_rows = self.engine.update(con, target_date)
+        if new_rows or changed or self.snapshot is None:
+            self.publish()
+        return new_rows
+
+    def publish(self):
+        def utc(timestamp):
+            return None if timestamp is None else pd.Timestamp(timestamp, unit='s', tz='UTC')
+
+        engine = self.engine
+        # the first row of the day is dropped, as data = raw_data.iloc[1:,:], so the window starts after it
+        start = int(engine.ids[0]) if engine.n else engine.start_time
+        kpis = engine.window(start)
+        timestamps, rates = engine.rolling_rates(start)
+        chart = pd.DataFrame({'rolling_ave': rates[0],
+                              'rolling_ave_part_1': rates[1],
+                              'rolling_ave_part_2': rates[2]},
+                             index=pd.to_datetime(timestamps, unit='s', utc=True))
+        snapshot = {'rows': max(engine.n - 1, 0),
+                    'total_stopped_time': kpis['total_stopped_time'],
+                    'total_cycling_time': kpis['total_cycling_time'],
+                    'total_1_parts_cast': kpis['total_1_parts'] + 0.01,
+                    'total_2_parts_cast': kpis['total_2_parts'] + 0.01,
+                    'total_cycles': kpis['total_cycles'],
+                    'ave_cycle_last_10': kpis['ave_cycle_last_n'],
+                    'last_cycle': utc(kpis['last_cycle']),
+                    'time_first_cycle': utc(kpis['first_cycle']),
+                    'time_first_box': utc(kpis['first_box']),
+                    'time_first_pour': utc(kpis['first_pour']),
+                    'image': f'images/{kpis['last_id']}.jpg',
+                    'chart': chart}
+        with self.condition:
+            self.version += 1
+            snapshot['version'] = self.version
+            self.snapshot = snapshot
+            self.condition.notify_all()
+
+    def start(self):
+        if self.event_port:
+            self.listener.start()
+        self.thread = threading.Thread(target=self.run, name='dashboard_data', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        con = sqlite3.connect(self.db_name)
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.update(con)
+                except sqlite3.Error as e:
+                    logging.error(f"Error reading dashboard data: {e}")
+                if self.listener.connected:
+                    self.listener.wait(self.idle_poll)
+                else:
+                    self.stop_event.wait(1)
+        finally:
+            con.close()
+
+    def wait(self, version, timeout):
+        '''Returns the latest snapshot once it is newer than version, or the current one after timeout seconds'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.snapshot is not None and self.version > version, timeout)
+            return self.snapshot
+
+    def close(self):
+        self.stop_event.set()
+        self.listener.close()
@@ -1,18 +1,20 @@
 
 # %%
-import pandas as pd
 import sqlite3
 import datetime
 import time
-import paho.mqtt.client as mqtt
 import json
 from dataclasses import dataclass, field
-import os
-import yaml
-from yaml import CLoader as Loader
 from typing import Dict
 import logging
 import pytz
+from kpi_engine import KpiEngine, kpi_message
+from cycle_events import CycleListener
+from cycle_schema import maintenance
+from mqtt_publisher import MqttPublisher
+from mqtt_connection import MqttConnection
+from config_watcher import ConfigWatcher
+from loop_profiler import LoopProfiler
 
 # %%
 
@@ -22,167 +24,116 @@ class config_default:
     port: int = 0
     stop_running: bool = False
     cell_name: str  = ''
-    shift_times  = {'0':[(4,30),(17,0)],
-                    '1':[(4,30),(17,0)],
-                    '2':[(4,30),(17,0)],
-                    '3':[(4,30),(17,0)],
-                    '4':[(4,30),(16,30)]}
-    shift_times_converted = {}
+    shift_times: Dict = field(default_factory=lambda: {'0':[(4,30),(17,0)],
+                                                       '1':[(4,30),(17,0)],
+                                                       '2':[(4,30),(17,0)],
+                                                       '3':[(4,30),(17,0)],
+                                                       '4':[(4,30),(16,30)]}) # weekday (Monday '0') -> [(hour, minute) start, end]
     db_name: str = 'disa3.db'
     mqtt_username: str = '' 
     mqtt_password: str = ''
     mqtt_host: str = ''
     mqtt_port: int = 0
     device_name: str =  "count_processor_dev"
+    event_port: int = 47651 # counter's cycle notification port, 0 to poll the database every second
+    idle_poll: float = 30 # longest wait between database reads while no cycles are notified
+    retention_days: int = 90 # days of cycles kept in the live table, older cycles move to counter_archive, 0 keeps all
+    archive_days: int = 0 # days of cycles kept in counter_archive, 0 keeps all, counter_hourly is always kept
+    history_dir: str = 'history' # Parquet files of closed days for long range queries, '' to not export
+    mqtt_qos: Dict = field(default_factory=dict) # QoS by topic, the last level of the topic, 1 when not given
+    profile_iterations: int = 0 # saving config.yaml with this set profiles that many loop iterations
+    profile_dir: str = 'profiles' # profile runs (.txt, .collapsed) are written here
+    profile_keep: int = 10 # newest profile runs kept in profile_dir
 
 
     
 
-    def convert_shift_time(self):
-        now = datetime.datetime.now()
-        for k, v  in self.shift_times.items():
-            self.shift_times_converted[k] = [datetime.datetime(year = now.year,
-                                                                 month = now.month,
-                                                                 day = now.day,
-                                                                 hour = v[0][0],
-                                                                 minute = v[0][1]),
-                                                datetime.datetime(year = now.year,
-                                                                 month = now.month,
-                                                                 day = now.day,
-                                                                 hour = v[1][0],
-                                                                 minute = v[1][1])]
-
-
-def get_config(config_path, old_config_mtime, config):
-    '''checks if config file has been updated and updates config instance of config_update class'''
-    try:
-        mtime = os.path.getmtime(config_path)
-    except:
-        return old_config_mtime, config
-    if mtime> old_config_mtime:
-        try:
-            configs =[]
-            with open(config_path, 'r') as files:
-                files = yaml.safe_load_all(files)
-                for file in files:
-                    configs.append([file])
-            yaml_data = configs[1][0]
-            config.stop_running = yaml_data['stop_running']
-            config.cell_name = yaml_data['cell_name']
-            config.shift_times = yaml_data['shift_times']
-            config.db_name = yaml_data['db_name']
-            old_config_mtime = mtime
-            config.mqtt_username = yaml_data['mqtt_username']
-            config.mqtt_password = yaml_data['mqtt_password']
-            config.mqtt_host = yaml_data['mqtt_host']
-            config.mqtt_port = yaml_data['mqtt_port']
-            config.device_name = yaml_data['device_name']
-        except:
-            return old_config_mtime, config
-    return old_config_mtime, config
-
-
-def get_data_from_db(con, start_time, end_time = None):
-    try:
-        cur = con.cursor()
-    except:
-        path = f"{config.db_name}"
-        con = sqlite3.connect(path)
-    if end_time == None:
-        data = pd.read_sql(f'select * from counter where id > {start_time}', con)
-    else:
-        data = pd.read_sql(f'select * from counter where id > {start_time} and id < {end_time}', con)
-    data['timestamp'] = pd.to_datetime(data['timestamp'], unit = 's')
-    data['running'] = ( data['timestamp']-data['timestamp'].shift(1)).dt.total_seconds()<45
-    data['ct2'] = data['timestamp'].diff(1).dt.total_seconds().fillna(0)
-    data = data[data['ct2']>7]
-    data = data[data['track_cycle']<10]
-    total_cycles_shift = data['ct'].count()
-
-    return data
- 
-
-def process_data(data):
-    try:
-        image = f'images/{data['id'].max()}.jpg'
-    except:
-        pass
-    message = {}
-
-    message['total_stopped_time'] = data[data['running']==False]['ct'].sum()
-    message['total_cycling_time'] = data[data['running']==True]['ct'].sum()
-    message['total_1_parts_cast'] = data['part_1'].sum()+0.01 
-    message['total_2_parts_cast'] = data['part_2'].sum()+0.01 
-    message['total_cycles'] = len(data)
-    message['time_on_hold'] = (datetime.datetime.now() - data['timestamp'].max()).seconds
-    message['ave_cycle_last_10'] = data['ct'][-10:].mean()
-
-    return message
+    shift_days: Dict = field(default_factory=dict, repr=False, compare=False) # date -> shift start and end datetimes
 
-# %%
+    def shift_bounds(self, day):
+        '''start and end of the shift on day (a date) as naive datetimes, computed once per day,
+        None when there is no shift on that weekday'''
+        if day not in self.shift_days:
+            times = self.shift_times.get(str(day.weekday()))
+            self.shift_days = {day: None if times is None else
+                               tuple(datetime.datetime.combine(day, datetime.time(*t)) for t in times)}
+        return self.shift_days[day]
 
-def start_mqtt():
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, f'{config.cell_name}_processor_to_mqtt_v1', clean_session = False)
-    client.username_pw_set(username = config.mqtt_username, password= config.mqtt_password)
-    client.will_set(f'tdg/tdf/{config.cell_name}/{config.device_name}/status', 'offline', retain=True, qos = 2)
-    client.reconnect_delay_set(min_delay=1, max_delay=120)
-    client.connect(config.mqtt_host, config.mqtt_port, 60)
-    client.loop_start()
-    return client
 
-def on_disconnect(client, userdata, rc, properties=None):
-    if rc != 0:
-        logging.error("Unexpected disconnection.")
-        client.loop_stop()
-        time.sleep(5)
+def parse_config(yaml_data):
+    '''builds a config_default from the processor's yaml document (document 1 of config.yaml), raises KeyError on
+    missing required keys and ValueError on shift times that are not [[hour, minute], [hour, minute]] per weekday'''
+    config = config_default()
+    config.stop_running = yaml_data['stop_running']
+    config.cell_name = yaml_data['cell_name']
+    config.shift_times = {}
+    for k, v in yaml_data['shift_times'].items():
+        start, end = (datetime.time(*t) for t in v) # ValueError/TypeError on bad hours or minutes
+        if str(k) not in '0123456' or len(str(k)) != 1 or start >= end:
+            raise ValueError(f"invalid shift times {k}: {v}")
+        config.shift_times[str(k)] = [(start.hour, start.minute), (end.hour, end.minute)]
+    config.db_name = yaml_data['db_name']
+    config.mqtt_username = yaml_data['mqtt_username']
+    config.mqtt_password = yaml_data['mqtt_password']
+    config.mqtt_host = yaml_data['mqtt_host']
+    config.mqtt_port = yaml_data['mqtt_port']
+    config.device_name = yaml_data['device_name']
+    config.event_port = yaml_data.get('event_port', config.event_port)
+    config.idle_poll = yaml_data.get('idle_poll', config.idle_poll)
+    config.retention_days = yaml_data.get('retention_days', config.retention_days)
+    config.archive_days = yaml_data.get('archive_days', config.archive_days)
+    config.history_dir = yaml_data.get('history_dir', config.history_dir)
+    config.mqtt_qos = yaml_data.get('mqtt_qos', config.mqtt_qos)
+    config.profile_iterations = yaml_data.get('profile_iterations', config.profile_iterations)
+    config.profile_dir = yaml_data.get('profile_dir', config.profile_dir)
+    config.profile_keep = yaml_data.get('profile_keep', config.profile_keep)
+    return config
 
 
 # %%
-def main(config, config_path, old_config_mtime):
-
-
+def main(config_watcher):
 
-    old_config_mtime, config = get_config(config_path, old_config_mtime, config)
-    config.convert_shift_time()
+    config = config_watcher.config
+    config_version = config_watcher.version
     lon = pytz.timezone("Europe/London")
     current_time = datetime.datetime.now(lon)
 
-    try:
-        client = start_mqtt()
-        client.on_disconnect = on_disconnect
-        message = {'status':'online', 'timestamp':current_time.timestamp(), 'timestamp_human': current_time.strftime("%d-%m-%y %H:%M:%S")}
-        client.publish(f'tdg/tdf/{config.cell_name}/{config.device_name}/status', json.dumps(message), retain=True, qos = 2)
-    except Exception as e:
-        logging.error(f"Error starting MQTT client: {e}")
-        pass
+    # per topic QoS, the latest message of each topic is kept and sent once the broker is reachable again
+    publisher = MqttPublisher(config.mqtt_qos)
+    publisher.start()
+
+    # connects and reconnects in the background, publishes the online status on every connect
+    mqtt_connection = MqttConnection(f'{config.cell_name}_processor_to_mqtt_v1', config.mqtt_host, config.mqtt_port,
+                                     config.mqtt_username, config.mqtt_password,
+                                     f'tdg/tdf/{config.cell_name}/{config.device_name}/status', publisher)
+    mqtt_connection.start()
 
     running_toggle = 0
     old_total_cycles_shift = 0
     old_total_cycles = 0
 
     con = sqlite3.connect(f"{config.db_name}")
+    maintenance_date = None
 
-    while True:
+    # cycle rows since the earlier of 04:00 and the shift start, only rows added since the last read are fetched
+    engine = KpiEngine()
 
-        if not client.is_connected() or not client:
-            try:
-                client.loop_stop()
-                client.disconnect()
-                logging.error("MQTT client disconnected")
-            except Exception as e:
-                logging.error(f"Error stopping or disconnecting MQTT client: {e}")
-                pass
-            try:
-                client = start_mqtt()
-                message = {'status':'online', 'timestamp':current_time.timestamp(), 'timestamp_human': current_time.strftime("%d-%m-%y %H:%M:%S")}
-                client.publish(f'tdg/tdf/{config.cell_name}/{config.device_name}/status', json.dumps(message), retain=True, qos = 2)
-            except Exception as e:
-                logging.error(f"Error starting MQTT client: {e}")
-                pass
+    # woken by the counter when a cycle is committed, falls back to polling when it is not reachable
+    listener = CycleListener(config.event_port)
+    if config.event_port:
+        listener.start()
+
+    # started from config.yaml, profiles a number of loop iterations in place
+    profiler = LoopProfiler('processor')
 
+    while True:
 
-        old_config_mtime, config = get_config(config_path, old_config_mtime, config)
-        config.convert_shift_time()
+        profiler.step()
+        if config_watcher.version != config_version: # reloaded by the watcher thread
+            config_version = config_watcher.version
+            config = config_watcher.config
+            if config.profile_iterations:
+                profiler.start(config.profile_iterations, config.profile_dir, config.profile_keep)
         current_time = datetime.datetime.now(lon)
         target_date = datetime.datetime(year = current_time.year,
                                         month = current_time.month,
@@ -190,23 +141,37 @@ def main(config, config_path, old_config_mtime):
                                         hour = 4,
                                         minute = 0).timestamp()
 
-        shift_start_time = config.shift_times_converted[str(current_time.weekday())][0].timestamp()
-        shift_end_time = config.shift_times_converted[str(current_time.weekday())][1].timestamp()
+        # no shift on this weekday gives an empty shift window
+        shift_start, shift_end = config.shift_bounds(current_time.date()) or (datetime.datetime.fromtimestamp(target_date),) * 2
+        shift_start_time = shift_start.timestamp()
+        shift_end_time = shift_end.timestamp()
+
+        # once a day: migrate the schema, roll up the hourly table, move old cycles to the archive
+        # and export the closed days to Parquet
+        if maintenance_date != target_date:
+            try:
+                maintenance(config.db_name, 'counter', config.retention_days, config.archive_days)
+                if config.history_dir:
+                    from cycle_history import export_days # pyarrow is only loaded once a day, not at startup
+                    export_days(config.db_name, 'counter', config.history_dir)
+            except Exception as e:
+                logging.error(f"Error in database maintenance: {e}")
+            maintenance_date = target_date
 
 
     # running data since 04:00
-        data = get_data_from_db(con, target_date)
-        total_cycles = len(data)
-        if len(data) <10: # check if data is present and sufficient
+        engine.update(con, min(target_date, shift_start_time))
+        daily = engine.window(target_date)
+        total_cycles = daily['total_cycles']
+        if total_cycles <10: # check if data is present and sufficient
             time.sleep(10)
             continue
 
-        processed_data = process_data(data)
+        processed_data = kpi_message(daily, datetime.datetime.now())
         if total_cycles != old_total_cycles:
             message_to_send = {k:v for k, v in processed_data.items()}
             message_to_send['timestamp'] = current_time.timestamp()
-            if client.is_connected():
-                client.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/daily_cycle_data", json.dumps(message_to_send), retain=True, qos=2)
+            publisher.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/daily_cycle_data", message_to_send, retain=True)
             old_total_cycles = total_cycles
 
     
@@ -215,61 +180,67 @@ def main(config, config_path, old_config_mtime):
             if running_toggle == 1:
                 running_toggle = 0
                 message = json.dumps({'timestamp':current_time.timestamp(),'running':'false', 'timestamp_human': current_time.strftime("%d-%m-%y %H:%M:%S")})
-                if client.is_connected():
-                    client.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/running", message, retain=True, qos=2)
+                publisher.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/running", message, retain=True)
 
         else:
             #status_holder.markdown('# :green[RUNNING]')
             if running_toggle == 0: 
                 running_toggle = 1
                 message = json.dumps({'timestamp':current_time.timestamp(),'running':'true','timestamp_human': current_time.strftime("%d-%m-%y %H:%M:%S")})
-                if client.is_connected():
-                    client.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/running", message, retain=True, qos=2)
+                publisher.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/running", message, retain=True)
 
 
 
     # running data within normal shift times
         
-        data_shift = get_data_from_db(con, shift_start_time, shift_end_time)
-        total_cycles_shift = len(data_shift)
-        if len(data_shift) <10: # check if data is present and sufficient
+        shift = engine.window(shift_start_time, shift_end_time)
+        total_cycles_shift = shift['total_cycles']
+        if total_cycles_shift <10: # check if data is present and sufficient
             time.sleep(10)
             continue
 
         try:
-            image = f'images/{data['id'].max()}.jpg'
+            image = f'images/{daily['last_id']}.jpg'
             with open(image, 'rb') as file:
                 image_file = file.read()
         except:
             image_file = 'None'
             pass
 
-        processed_shift_data = process_data(data_shift)
+        processed_shift_data = kpi_message(shift, datetime.datetime.now())
 
         if total_cycles_shift != old_total_cycles_shift:
             message_to_send = {k:v for k, v in processed_shift_data.items()}
-            message_to_send["shift_start_human"] = config.shift_times_converted[str(datetime.datetime.now().weekday())][0].strftime('%d-%m-%y %H:%M:%S'),
-            message_to_send["shift_end_human"] = config.shift_times_converted[str(datetime.datetime.now().weekday())][1].strftime('%d-%m-%y %H:%M:%S'),
-            message_to_send["shift_start"] = config.shift_times_converted[str(datetime.datetime.now().weekday())][0].timestamp(),
-            message_to_send["shift_end"] = config.shift_times_converted[str(datetime.datetime.now().weekday())][1].timestamp(),
+            message_to_send["shift_start_human"] = shift_start.strftime('%d-%m-%y %H:%M:%S'),
+            message_to_send["shift_end_human"] = shift_end.strftime('%d-%m-%y %H:%M:%S'),
+            message_to_send["shift_start"] = shift_start_time,
+            message_to_send["shift_end"] = shift_end_time,
             message_to_send['timestamp'] = current_time.timestamp()
             message_to_send['timestamp_human'] =  current_time.strftime("%d-%m-%y %H:%M:%S")
-            if client.is_connected():
-                client.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/shift_cycle_data", json.dumps(message_to_send), retain=True, qos=2)
+            publisher.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/shift_cycle_data", message_to_send, retain=True)
             old_total_cycles_shift = total_cycles_shift
 
             if image:
                 #byteArr = bytearray(image_file)
                 message_to_send = {'image':'none', 'timestamp':current_time.timestamp()}
-                if client.is_connected():
-                    client.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/cycle_image", json.dumps(message_to_send), retain=True, qos=2)
+                publisher.publish(f"tdg/tdf/{config.cell_name}/{config.device_name}/cycle_image", message_to_send, retain=True)
     
 
-        time.sleep(1)
+        # sleep until the next cycle, the point the line would change to not running, or idle_poll
+        if listener.connected:
+            timeout = config.idle_poll
+            if running_toggle == 1:
+                timeout = min(timeout, max(45 - processed_data['time_on_hold'], 1))
+            listener.wait(timeout)
+        else:
+            time.sleep(1)
 
         if config.stop_running == True:
             break
 
+    mqtt_connection.stop()
+    publisher.close()
+
 if __name__ == '__main__':
 
     ## set up logging
@@ -279,11 +250,11 @@ if __name__ == '__main__':
                         filemode='a')
     logging.debug('log started')
 
-    config_path  = "config.yaml"
-    old_config_mtime = 0  # mtime is time file is modified
+    # the processor's settings are document 1 of config.yaml, reloaded in the background when the file changes
+    config_watcher = ConfigWatcher("config.yaml", 1, parse_config, config_default())
+    config_watcher.start()
 
-    config = config_default()
-    
-    main(config, config_path, old_config_mtime)
+    main(config_watcher)
+    config_watcher.stop()
 
 # %%
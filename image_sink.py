@@ -0,0 +1,95 @@
+import cv2
+import numpy as np
+import threading
+import queue
+import time
+import os
+import logging
+
+
+class ImageSink:
+    '''Saves cycle snapshots from a background thread so encoding never runs in the frame loop.
+    save() crops and copies the frame and queues it, the worker thread resizes, encodes and writes the file.
+    The queue is bounded, when it is full the snapshot is dropped (and counted) rather than blocking the caller.
+    Files are written to a temporary name and renamed, so readers never see a half written image.
+    usage: sink = ImageSink('images', quality=80, scale=0.5)
+           sink.start()
+           sink.save(cycle.id, frame)
+           sink.close()
+    args: image_dir: str: directory for <id>.<format> files
+          quality: int: JPEG/WebP quality 0-100
+          scale: float: resize factor applied before encoding
+          roi: list: optional [x0, y0, x1, y1] crop applied before encoding
+          image_format: str: 'jpg' or 'webp'
+          max_queue: int: snapshots waiting to be written before new ones are dropped
+          observe: callable: called with ('image_write', seconds) for each snapshot encoded and written'''
+
+    def __init__(self, image_dir='images', quality=95, scale=1.0, roi=None, image_format='jpg', max_queue=4, observe=None):
+        if image_format not in ('jpg', 'webp'):
+            raise ValueError(f"Unsupported image format {image_format}")
+        self.image_dir = image_dir
+        self.quality = quality
+        self.scale = scale
+        self.roi = roi
+        self.image_format = image_format
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.observe = observe
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='image_sink', daemon=True)
+        self.thread.start()
+
+    def save(self, id, frame):
+        '''Queues a copy of the frame (or its roi) to be written as <id>.<format>, returns False if dropped'''
+        if self.queue.full():
+            self.dropped += 1
+            return False
+        if self.roi:
+            x0, y0, x1, y1 = self.roi
+            frame = frame[y0:y1, x0:x1]
+        try:
+            # copy here, the caller may reuse or draw on the frame as soon as save returns
+            self.queue.put_nowait((id, np.array(frame)))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def encode_params(self):
+        if self.image_format == 'webp':
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+
+    def write(self, id, frame):
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode(f'.{self.image_format}', frame, self.encode_params())
+        if not ret:
+            logging.error(f"Error encoding image {id}")
+            return
+        path = os.path.join(self.image_dir, f'{id}.{self.image_format}')
+        with open(path + '.tmp', 'wb') as file:
+            file.write(buffer.tobytes())
+        os.replace(path + '.tmp', path)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            start = time.perf_counter()
+            try:
+                self.write(*item)
+                if self.observe is not None:
+                    self.observe('image_write', time.perf_counter() - start)
+            except Exception as e:
+                logging.error(f"Error writing image {item[0]}: {e}")
+
+    def close(self, timeout=10):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+        if self.dropped:
+            logging.info(f"{self.dropped} snapshots dropped because the image queue was full")
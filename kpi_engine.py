@@ -0,0 +1,205 @@
+import datetime
+import numpy as np
+
+# Cycle KPIs for the processor and the dashboard, from one set of numpy arrays instead of repeated pandas masks.
+# Rows are appended as they are committed and every per row quantity is kept as a prefix sum, so the totals of
+# any window (day, shift, hour or the last N cycles) are a few searchsorted lookups, whatever its length.
+# The rules are those of the original process_data: within a window (id > start and id < end) a row counts when
+# it is more than 7 s after the previous row and track_cycle < 10, the first row of the window never counts,
+# and a counted row is running time when it is less than 45 s after the previous row, stopped time otherwise.
+
+COLUMNS = "id, timestamp, track_cycle, part_1, part_2, ct, sent"
+
+# per row quantities kept as prefix sums over the counted rows
+SUMS = ('cycles', 'running_ct', 'stopped_ct', 'ct', 'part_1', 'part_2', 'box', 'pour')
+
+
+class KpiEngine:
+    '''Cycle rows since a start time as growing numpy arrays with prefix sums.
+    usage: engine = KpiEngine()
+           engine.update(con, day_start)
+           daily = engine.window(day_start)
+           shift = engine.window(shift_start, shift_end)
+           message = kpi_message(daily, datetime.datetime.now())
+    args: table: str: table holding the cycle rows
+          capacity: int: rows allocated up front, doubled when full'''
+
+    def __init__(self, table='counter', capacity=4096):
+        self.table = table
+        self.capacity = capacity
+        self.clear(None)
+
+    def clear(self, start_time):
+        self.start_time = start_time
+        self.last_id = start_time
+        self.n = 0
+        self.ids = np.zeros(self.capacity, np.int64)
+        self.timestamps = np.zeros(self.capacity)
+        self.ct = np.zeros(self.capacity)
+        self.counted = np.zeros(self.capacity, bool)
+        self.flags = {name: np.zeros(self.capacity, bool) for name in ('part_1', 'part_2', 'box')}
+        self.sums = {name: np.zeros(self.capacity + 1) for name in SUMS}
+
+    def grow(self, size):
+        capacity = len(self.ids)
+        while capacity < size:
+            capacity *= 2
+        if capacity == len(self.ids):
+            return
+
+        def resized(array, length):
+            bigger = np.zeros(length, array.dtype)
+            bigger[:len(array)] = array
+            return bigger
+        self.ids = resized(self.ids, capacity)
+        self.timestamps = resized(self.timestamps, capacity)
+        self.ct = resized(self.ct, capacity)
+        self.counted = resized(self.counted, capacity)
+        self.flags = {name: resized(array, capacity) for name, array in self.flags.items()}
+        self.sums = {name: resized(array, capacity + 1) for name, array in self.sums.items()}
+
+    def extend(self, rows):
+        '''Appends (id, timestamp, track_cycle, part_1, part_2, ct, sent) rows in id order, a list or a 2d array'''
+        if len(rows) == 0:
+            return
+        rows = np.array(rows, dtype=float) # None becomes nan, and nan never compares true
+        k = len(rows)
+        n = self.n
+        self.grow(n + k)
+        ids, timestamps, track_cycle, part_1, part_2, ct, sent = rows.T
+
+        previous = np.empty(k)
+        previous[0] = self.timestamps[n-1] if n else np.nan
+        previous[1:] = timestamps[:-1]
+        gap = timestamps - previous
+        counted = (gap > 7) & (track_cycle < 10)
+        running = gap < 45
+        ct = np.nan_to_num(ct)
+
+        self.ids[n:n+k] = ids
+        self.timestamps[n:n+k] = timestamps
+        self.ct[n:n+k] = ct
+        self.counted[n:n+k] = counted
+        self.flags['part_1'][n:n+k] = part_1 == 1
+        self.flags['part_2'][n:n+k] = part_2 == 1
+        self.flags['box'][n:n+k] = sent == 1
+        values = {'cycles': counted,
+                  'running_ct': ct * (counted & running),
+                  'stopped_ct': ct * (counted & ~running),
+                  'ct': ct * counted,
+                  'part_1': np.nan_to_num(part_1) * counted,
+                  'part_2': np.nan_to_num(part_2) * counted,
+                  'box': (sent == 1) & counted,
+                  'pour': ((part_1 == 1) | (part_2 == 1)) & counted}
+        for name, value in values.items():
+            self.sums[name][n+1:n+k+1] = self.sums[name][n] + np.cumsum(value)
+        self.n = n + k
+        self.last_id = int(ids[-1])
+
+    def update(self, con, start_time):
+        '''Reads the rows newer than the last seen id, starting again when start_time changes. Returns the number read'''
+        if start_time != self.start_time:
+            self.clear(start_time)
+        rows = con.execute(f'select {COLUMNS} from {self.table} where id > ? order by id', (self.last_id,)).fetchall()
+        self.extend(rows)
+        return len(rows)
+
+    def bounds(self, start=None, end=None):
+        '''Row range [lo, hi) of the rows that can count in the window id > start and id < end'''
+        ids = self.ids[:self.n]
+        first = 0 if start is None else int(np.searchsorted(ids, start, 'right'))
+        hi = self.n if end is None else max(int(np.searchsorted(ids, end, 'left')), first)
+        return min(first + 1, hi), hi # the first row of a window never counts
+
+    def first(self, name, lo, hi):
+        '''Index of the first counted row in [lo, hi) with sums[name] increasing, or None'''
+        sums = self.sums[name][:self.n+1]
+        i = int(np.searchsorted(sums, sums[lo], 'right')) - 1
+        return i if i < hi else None
+
+    def window(self, start=None, end=None, last_n=10):
+        '''KPIs for the rows with start < id < end, as a dict'''
+        lo, hi = self.bounds(start, end)
+        totals = {name: float(self.sums[name][hi] - self.sums[name][lo]) for name in SUMS}
+        cycles = int(totals['cycles'])
+
+        def timestamp(i):
+            return None if i is None else float(self.timestamps[i])
+
+        last = None
+        last_ct = []
+        if cycles:
+            count = self.sums['cycles'][:self.n+1]
+            last = int(np.searchsorted(count, count[hi], 'left')) - 1
+            n = min(last_n, cycles)
+            i = int(np.searchsorted(count, count[hi] - n, 'right')) - 1
+            last_ct = self.ct[i:hi][self.counted[i:hi]]
+        return {'total_stopped_time': totals['stopped_ct'],
+                'total_cycling_time': totals['running_ct'],
+                'total_1_parts': totals['part_1'],
+                'total_2_parts': totals['part_2'],
+                'total_cycles': cycles,
+                'total_boxes': int(totals['box']),
+                'ave_cycle_last_n': float(np.mean(last_ct)) if len(last_ct) else float('nan'),
+                'last_id': None if last is None else int(self.ids[last]),
+                'last_cycle': timestamp(last),
+                'first_cycle': timestamp(self.first('cycles', lo, hi)),
+                'first_box': timestamp(self.first('box', lo, hi)),
+                'first_pour': timestamp(self.first('pour', lo, hi))}
+
+    def windows(self, edges, exclude_first=False):
+        '''Totals for the windows edges[i] <= id < edges[i+1] (e.g. hours) in one vectorised pass.
+        Returns a dict of arrays of length len(edges) - 1. exclude_first applies the first row rule per window,
+        off by default so the windows add up to the whole range'''
+        ids = self.ids[:self.n]
+        edges = np.asarray(edges)
+        lo = np.searchsorted(ids, edges[:-1], 'left')
+        hi = np.searchsorted(ids, edges[1:], 'left')
+        if exclude_first:
+            lo = np.minimum(lo + 1, np.maximum(hi, lo))
+        return {name: self.sums[name][hi] - self.sums[name][lo] for name in SUMS}
+
+    def rolling_rates(self, start=None, end=None, span=600, min_periods=3):
+        '''Timestamps of the counted rows in the window and 3600 / mean ct over the preceding span seconds,
+        for all counted rows and for the part 1 and part 2 rows alone (nan on the other rows).
+        Same values as pandas rolling(f'{span}s', min_periods=min_periods) on a timestamp index'''
+        lo, hi = self.bounds(start, end)
+        selected = self.counted[lo:hi]
+        timestamps = self.timestamps[lo:hi][selected]
+        ct = self.ct[lo:hi][selected]
+        rates = [rolling_rate(timestamps, ct, span, min_periods)]
+        for name in ('part_1', 'part_2'):
+            mask = self.flags[name][lo:hi][selected]
+            rate = np.full(len(timestamps), np.nan)
+            rate[mask] = rolling_rate(timestamps[mask], ct[mask], span, min_periods)
+            rates.append(rate)
+        return timestamps, rates
+
+
+def rolling_rate(timestamps, values, span=600, min_periods=3):
+    '''3600 / mean of values over the window (t - span, t] at each of the ascending timestamps'''
+    right = np.arange(1, len(timestamps) + 1)
+    left = np.searchsorted(timestamps, timestamps - span, 'right')
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    count = right - left
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = 3600 * count / (sums[right] - sums[left])
+    rate[count < min_periods] = np.nan
+    return rate
+
+
+def kpi_message(kpis, now):
+    '''Processor message for a window, same keys and values as the original process_data'''
+    if kpis['last_cycle'] is None:
+        time_on_hold = None
+    else:
+        # process_data compares naive UTC timestamps with the naive local clock, kept for identical output
+        last_cycle = datetime.datetime.fromtimestamp(kpis['last_cycle'], datetime.timezone.utc).replace(tzinfo=None)
+        time_on_hold = (now - last_cycle).seconds
+    return {'total_stopped_time': kpis['total_stopped_time'],
+            'total_cycling_time': kpis['total_cycling_time'],
+            'total_1_parts_cast': kpis['total_1_parts'] + 0.01,
+            'total_2_parts_cast': kpis['total_2_parts'] + 0.01,
+            'total_cycles': kpis['total_cycles'],
+            'time_on_hold': time_on_hold,
+            'ave_cycle_last_10': kpis['ave_cycle_last_n']}
@@ -0,0 +1,117 @@
+import collections
+import datetime
+import threading
+import time
+import sys
+import os
+import glob
+import logging
+
+
+class LoopProfiler:
+    '''Sampling profiler for a number of iterations of a service loop, started on request so a running counter or
+    processor can be diagnosed in place. A sampler thread records the loop thread's stack every interval seconds;
+    only that thread is sampled, the writer, MQTT and other background threads do not show up.
+    When the iterations are done two files are written to directory and only the newest keep runs are kept:
+    <name>_<time>.txt: functions by total and self time (share of samples, scaled to the run's duration)
+    <name>_<time>.collapsed: one "root;...;leaf count" line per stack, for flamegraph.pl or speedscope
+    usage: profiler = LoopProfiler('counter')
+           while True:
+               profiler.step() # first thing in every iteration
+               if config changed and config.profile_iterations:
+                   profiler.start(config.profile_iterations, config.profile_dir, config.profile_keep)
+    args: name: str: file name prefix of the runs
+          interval: float: seconds between stack samples'''
+
+    def __init__(self, name, interval=0.002):
+        self.name = name
+        self.interval = interval
+        self.running = False
+        self.remaining = 0
+        self.iterations = 0
+        self.directory = 'profiles'
+        self.keep = 10
+        self.stacks = collections.Counter()
+        self.start_time = 0.0
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.thread_id = None
+
+    def start(self, iterations, directory='profiles', keep=10):
+        '''Profiles the next iterations loop iterations, a run already going is written first'''
+        if self.running:
+            self.finish()
+        self.iterations = self.remaining = iterations
+        self.directory = directory
+        self.keep = keep
+        self.stacks = collections.Counter()
+        self.thread_id = threading.get_ident()
+        self.stop_event.clear()
+        self.start_time = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, name='loop_profiler', daemon=True)
+        self.sampler.start()
+        self.running = True
+        logging.info(f"Profiling {iterations} iterations of the {self.name} loop")
+
+    def step(self):
+        if not self.running:
+            return
+        self.remaining -= 1
+        if self.remaining < 0: # the iteration that called start is not counted
+            self.finish()
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def finish(self):
+        self.stop_event.set()
+        self.sampler.join()
+        self.running = False
+        elapsed = time.perf_counter() - self.start_time
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # milliseconds, two runs requested within a second do not overwrite each other and still sort by time
+            path = os.path.join(self.directory, f"{self.name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]}")
+            with open(path + '.txt', 'w') as file:
+                file.write(self.report(elapsed))
+            with open(path + '.collapsed', 'w') as file:
+                for stack, count in self.stacks.most_common():
+                    file.write(f'{stack} {count}\n')
+            self.rotate()
+            logging.info(f"Profile written to {path}.txt/.collapsed")
+        except Exception as e:
+            logging.error(f"Error writing profile: {e}")
+
+    def report(self, elapsed, top=50):
+        samples = sum(self.stacks.values())
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(';')
+            own[functions[-1]] += count
+            for function in set(functions): # recursion counts once per stack
+                total[function] += count
+        lines = [f"{self.name}: {self.iterations} iterations, {elapsed:.2f} s, {samples} samples",
+                 f"{elapsed/max(self.iterations, 1)*1000:.2f} ms per iteration", '',
+                 f"{'total %':>8} {'total ms':>10} {'self %':>8} {'self ms':>10}  function"]
+        for function, count in total.most_common(top):
+            lines.append(f"{100*count/samples:8.1f} {elapsed*1000*count/samples:10.1f} "
+                         f"{100*own[function]/samples:8.1f} {elapsed*1000*own[function]/samples:10.1f}  {function}")
+        return '\n'.join(lines) + '\n'
+
+    def rotate(self):
+        runs = sorted(glob.glob(os.path.join(self.directory, f'{self.name}_*.txt')))
+        for old in runs[:max(len(runs) - self.keep, 0)]:
+            for extension in ('.txt', '.collapsed'):
+                try:
+                    os.remove(old[:-len('.txt')] + extension)
+                except FileNotFoundError:
+                    pass
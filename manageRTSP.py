@@ -1,60 +1,219 @@
 import multiprocessing
+from multiprocessing import shared_memory
 import threading
 import cv2
+import numpy as np
 import queue
 import time
+import logging
+
+
+class SharedFrameRing:
+    '''Ring of preallocated frame slots in multiprocessing.shared_memory, used instead of the frame queue
+    so frames are not pickled and piped between the frame reader process and the main process.
+    The reader process copies each decoded frame into a free slot and publishes it with a sequence number.
+    get returns a numpy view of the newest frame, frames not collected in time are skipped (latest frame wins).
+    The slot handed to the main process is not written again until the next get, so the view stays valid until then.
+    After get, frame_time is when the frame was published and dropped counts the frames that were never collected.
+    A frame larger than a slot is refused and sets oversized, which wakes get, the caller then passes frames another way.
+    args: max_frame_shape: tuple: largest (height, width, channels) uint8 frame a slot can hold
+          slots: int: number of slots, at least 3 (newest frame, frame in use and frame being written)
+    methods: reset: Method to recreate the locks and counters before a new reader process is started
+             put: Method used by the reader process to publish a frame
+             get: Method to wait for and return a view of the newest frame
+             close: Method to release and unlink the shared memory'''
+
+    def __init__(self, max_frame_shape=(1080, 1920, 3), slots=3):
+        if slots < 3:
+            raise ValueError("SharedFrameRing needs at least 3 slots")
+        self.slots = slots
+        self.slot_size = int(np.prod(max_frame_shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size * slots)
+        self.shapes = multiprocessing.RawArray('i', slots * 3)
+        self.put_times = multiprocessing.RawArray('d', slots)
+        self.oversized = multiprocessing.RawValue('i', 0) # kept across restarts, the camera resolution does not change
+        self.frame_time = 0.0
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        # a terminated reader process can leave the lock held, so everything is recreated on restart
+        self.lock = multiprocessing.Lock()
+        self.new_frame = multiprocessing.Event()
+        self.seq = multiprocessing.RawValue('q', 0)
+        self.latest = multiprocessing.RawValue('i', -1)
+        self.reading = multiprocessing.RawValue('i', -1)
+        self.last_seq = 0
+
+    def slot_view(self, slot, shape):
+        return np.ndarray(shape, np.uint8, self.shm.buf, slot * self.slot_size)
+
+    def put(self, frame):
+        if frame.nbytes > self.slot_size:
+            self.oversized.value = 1
+            self.new_frame.set()
+            return False
+        with self.lock:
+            slot = (self.latest.value + 1) % self.slots
+            while slot == self.latest.value or slot == self.reading.value:
+                slot = (slot + 1) % self.slots
+        np.copyto(self.slot_view(slot, frame.shape), frame)
+        self.shapes[slot*3:slot*3+3] = frame.shape if frame.ndim == 3 else (*frame.shape, 0)
+        self.put_times[slot] = time.time()
+        with self.lock:
+            self.latest.value = slot
+            self.seq.value += 1
+            self.new_frame.set()
+        return True
+
+    def get(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                if self.seq.value > self.last_seq:
+                    slot = self.latest.value
+                    self.reading.value = slot
+                    self.dropped += self.seq.value - self.last_seq - 1
+                    self.last_seq = self.seq.value
+                    break
+                self.new_frame.clear()
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.new_frame.wait(remaining) or self.oversized.value:
+                return None
+        self.frame_time = self.put_times[slot]
+        height, width, channels = self.shapes[slot*3:slot*3+3]
+        return self.slot_view(slot, (height, width, channels) if channels else (height, width))
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            print("Shared memory still referenced by a frame, unlinking only")
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
 
 class FrameReader:
     '''class to read frames from an RTSP stream using OpenCV and multiprocessing. 
     Restarts the frame reader process if no frame is captured within a specified timeout period.
-    cummuncaiton between the main process and the frame reader process is done using a multiprocessing.Queue.
+    cummuncaiton between the main process and the frame reader process is done using a multiprocessing.Queue,
+    or a SharedFrameRing when shared_memory is True. Frames larger than max_frame_shape go through the queue.
+    After get_frame, wait_time is how long it waited for the frame and frame_age how long the frame waited
+    between the reader process and the caller.
     usage: Create an instance of the FrameReader class and call the run method.
     args: rtsp_url: str: RTSP URL of the stream
           timeout: int: Timeout period in seconds to wait for a frame
           restart_delay: int: Delay in seconds before restarting the frame reader process
+          shared_memory: bool: Pass frames through shared memory, get_frame then returns a view valid until the next call
+          max_frame_shape: tuple: Largest (height, width, channels) frame the shared memory slots can hold, after scale
+          slots: int: Number of shared memory slots
+          decimate: int: Retrieve only every nth frame, the others are grabbed and discarded without being retrieved
+          target_fps: float: Retrieve at most this many frames per second, 0 retrieves every (decimated) frame
+          idle_interval: float: While set, the stream is closed between frames and opened again every idle_interval
+                         seconds for one frame, so nothing is decoded in between, 0 reads the stream continuously
+          scale: float: Resize factor applied in the frame reader process before the frame is passed on
+          grayscale: bool: Convert to single channel gray in the frame reader process
+          hw_decode: bool: Ask the capture backend for any available hardware accelerated decoder
     methods: frame_reader: Method to read frames from the RTSP stream
+                prepare_frame: Method to resize and convert a decoded frame in the frame reader process
                 frame_reader_process: Method to create a process to read frames from the RTSP stream
                 start_frame_reader: Method to start the frame reader process
                 stop_frame_reader: Method to stop the frame reader process
                 get_frame: Method to get a frame from the frame queue
+                set_target_fps: Method to change the retrieve rate while the reader process runs
+                set_idle_interval: Method to switch the running reader process between continuous and idle reading
+                dropped_frames: Method to count the frames replaced before the main process collected them
                 run: Method to run the frame reader process
+                close: Method to stop the frame reader process and release shared memory
      
     FrameReader instance will read frames from the RTSP stream and display them using OpenCV.
     returns: None'''
 
-    def __init__(self, rtsp_url, timeout=5, restart_delay=5):
+    def __init__(self, rtsp_url, timeout=5, restart_delay=5, shared_memory=False, max_frame_shape=(1080, 1920, 3), slots=3,
+                 decimate=1, target_fps=0, scale=1.0, grayscale=False, hw_decode=False, idle_interval=0):
         self.rtsp_url = rtsp_url
         self.timeout = timeout
         self.restart_delay = restart_delay
+        self.decimate = max(int(decimate), 1)
+        self.target_fps = multiprocessing.RawValue('d', target_fps) # changed by set_target_fps while the reader runs
+        self.idle_interval = multiprocessing.RawValue('d', idle_interval) # changed by set_idle_interval
+        self.scale = scale
+        self.grayscale = grayscale
+        self.hw_decode = hw_decode
+        self.max_frame_shape = tuple(max_frame_shape)
         self.frame_queue = multiprocessing.Queue(maxsize=1)
+        self.frame_ring = SharedFrameRing(self.max_frame_shape, slots) if shared_memory else None
         self.stop_event = multiprocessing.Event()
+        self.dropped = multiprocessing.RawValue('q', 0) # frames replaced in the queue by the reader process
         self.process = None
         self.last_frame_time = time.time()
+        self.wait_time = 0.0
+        self.frame_age = 0.0
+
+    def prepare_frame(self, frame):
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.grayscale:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
 
     def frame_reader(self, cap, frame_queue, stop_event):
+        grabbed = 0
+        last_retrieve_time = 0
         while not stop_event.is_set():
-            ret, frame = cap.read()
-            if ret:
+            # grab() advances the stream, only frames that will be used pay for retrieve() (colour conversion and copy)
+            if not cap.grab():
+                print("Failed to read frame")
+                continue
+            grabbed += 1
+            if grabbed % self.decimate:
+                continue
+            target_fps = self.target_fps.value
+            if target_fps:
+                now = time.time()
+                if now - last_retrieve_time < 1/target_fps:
+                    continue
+                last_retrieve_time = now
+            ret, frame = cap.retrieve()
+            if not ret:
+                print("Failed to read frame")
+                continue
+            frame = self.prepare_frame(frame)
+            if self.frame_ring is None or not self.frame_ring.put(frame): # no shared memory, or the frame does not fit a slot
                 if not frame_queue.empty():
                     try:
                         frame_queue.get_nowait()  # Remove the old frame
+                        self.dropped.value += 1
                     except queue.Empty:
                         pass
-                frame_queue.put(frame)
-            else:
-                print("Failed to read frame")
+                frame_queue.put((time.time(), frame))
+            if self.idle_interval.value: # one frame per connection while idle
+                return
 
     def frame_reader_process(self, rtsp_url, frame_queue, stop_event):
-        cap = cv2.VideoCapture(rtsp_url)
-        if not cap.isOpened():
-            print("Error: Cannot open RTSP stream")
-            return
-        reader_thread = threading.Thread(target=self.frame_reader, args=(cap, frame_queue, stop_event))
-        reader_thread.start()
-        reader_thread.join()
-        cap.release()
+        while not stop_event.is_set():
+            opened = time.time()
+            if self.hw_decode:
+                cap = cv2.VideoCapture(rtsp_url, cv2.CAP_ANY, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+            else:
+                cap = cv2.VideoCapture(rtsp_url)
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # keep the backend from queueing stale frames
+            if not cap.isOpened():
+                print("Error: Cannot open RTSP stream")
+                return
+            reader_thread = threading.Thread(target=self.frame_reader, args=(cap, frame_queue, stop_event))
+            reader_thread.start()
+            reader_thread.join() # returns after one frame while idle
+            cap.release()
+            # closed until the next idle frame is due, reading continuously again as soon as idle is cleared
+            while self.idle_interval.value and time.time() < opened + self.idle_interval.value:
+                if stop_event.wait(0.05):
+                    return
 
     def start_frame_reader(self):
+        if self.frame_ring is not None:
+            self.frame_ring.reset()
         self.process = multiprocessing.Process(target=self.frame_reader_process, args=(self.rtsp_url, self.frame_queue, self.stop_event))
         self.process.start()
 
@@ -66,13 +225,28 @@ class FrameReader:
             self.stop_event.clear()
 
     def get_frame(self):
+        start = time.time()
+        ring = self.frame_ring
+        timeout = self.timeout + self.idle_interval.value # idle frames take an interval and a reconnect
         try:
-            frame = self.frame_queue.get(timeout=self.timeout)
+            frame = None
+            if ring is not None and not ring.oversized.value:
+                frame = ring.get(timeout)
+                if frame is None and not ring.oversized.value:
+                    raise queue.Empty
+                frame_time = ring.frame_time
+                if frame is None:
+                    logging.error(f"Frames larger than the shared memory slots {self.max_frame_shape}, "
+                                  f"passing them through the queue")
+            if frame is None:
+                frame_time, frame = self.frame_queue.get(timeout=timeout)
             self.last_frame_time = time.time()
+            self.wait_time = self.last_frame_time - start
+            self.frame_age = max(self.last_frame_time - frame_time, 0.0)
             return frame
         except queue.Empty:
             print("No frame captured within the timeout period")
-            if time.time() - self.last_frame_time > self.timeout:
+            if time.time() - self.last_frame_time > timeout:
                 print("Restarting frame reader process")
                 self.stop_frame_reader()
                 time.sleep(self.restart_delay)  # Delay before restarting the process
@@ -80,6 +254,22 @@ class FrameReader:
                 self.last_frame_time = time.time()
             return None
 
+    def set_target_fps(self, target_fps):
+        '''Changes the retrieve rate of the running reader process, 0 retrieves every (decimated) frame'''
+        self.target_fps.value = target_fps
+
+    def set_idle_interval(self, idle_interval):
+        '''Closes the stream between frames, read one every idle_interval seconds, 0 reads continuously again'''
+        self.idle_interval.value = idle_interval
+
+    def dropped_frames(self):
+        return self.dropped.value + (self.frame_ring.dropped if self.frame_ring is not None else 0)
+
+    def close(self):
+        self.stop_frame_reader()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+
     def run(self):
         self.start_frame_reader()
         try:
@@ -92,7 +282,7 @@ class FrameReader:
                 else:
                     print("No frame captured")
         finally:
-            self.stop_frame_reader()
+            self.close()
             cv2.destroyAllWindows()
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+import bisect
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Hot path latency histograms and counters for the counter, served as Prometheus text over HTTP and sent
+# periodically as a JSON message (for the MQTT metrics topic).
+# Bucket bounds grow by 2**0.25 from 50 us to about 3 s, so observe() is a bisect and two additions, and
+# quantiles interpolated within a bucket are within a few percent.
+
+BUCKETS = tuple(50e-6 * 2 ** (i / 4) for i in range(64))
+
+
+class Histogram:
+    '''Latency histogram with fixed log spaced buckets, safe to observe from several threads'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # the last bucket holds values above BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def state(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+    @staticmethod
+    def quantile(counts, q):
+        '''Value below which q of the observations in counts fall, interpolated within the bucket'''
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i-1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Metrics:
+    '''Named latency histograms plus counters and gauges read when the metrics are collected.
+    Stages are observed in seconds from any thread. Counters and gauges are callables (e.g. a frame reader's
+    dropped frame count), so nothing is updated in the frame loop for them.
+    serve() starts the HTTP endpoint (GET /metrics, Prometheus text format) and report() calls a callback every
+    interval seconds with a message of p50/p95/p99 in ms per stage over the interval, plus the counters and gauges.
+    usage: metrics = Metrics('counter')
+           metrics.counter('reader_dropped_frames', frame_reader.dropped_frames)
+           metrics.serve(9108)
+           metrics.report(lambda message: publisher.publish(topic, message), 60)
+           metrics.observe('flow', seconds)
+           metrics.close()
+    args: prefix: str: prefix of the Prometheus metric names'''
+
+    def __init__(self, prefix='counter'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.values = {} # name -> (callable, 'counter' or 'gauge')
+        self.reported = {} # stage -> bucket counts at the last report
+        self.lock = threading.Lock()
+        self.server = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def counter(self, name, read):
+        self.values[name] = (read, 'counter')
+
+    def gauge(self, name, read):
+        self.values[name] = (read, 'gauge')
+
+    def read_values(self):
+        values = {}
+        for name, (read, kind) in list(self.values.items()):
+            try:
+                values[name] = read()
+            except Exception as e:
+                logging.error(f"Error reading metric {name}: {e}")
+        return values
+
+    def prometheus(self):
+        '''All metrics in the Prometheus text exposition format'''
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# HELP {name} Time spent in each stage of the counter', f'# TYPE {name} histogram']
+        quantiles = []
+        for stage, histogram in sorted(self.histograms.items()):
+            counts, count, total = histogram.state()
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+            for q in (0.5, 0.95, 0.99):
+                value = Histogram.quantile(counts, q)
+                if value is not None:
+                    quantiles.append(f'{name}_quantile{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+        if quantiles:
+            lines += [f'# HELP {name}_quantile Stage time quantiles since start', f'# TYPE {name}_quantile gauge'] + quantiles
+        values = self.read_values()
+        for key, value in values.items():
+            kind = self.values[key][1]
+            metric = f'{self.prefix}_{key}' + ('_total' if kind == 'counter' else '')
+            lines += [f'# TYPE {metric} {kind}', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def message(self):
+        '''p50/p95/p99 and mean in ms per stage since the last message, and the current counters and gauges'''
+        stages = {}
+        for stage, histogram in sorted(self.histograms.items()):
+            counts, count, total = histogram.state()
+            previous = self.reported.get(stage, [0] * len(counts))
+            window = [n - p for n, p in zip(counts, previous)]
+            self.reported[stage] = counts
+            n = sum(window)
+            if not n:
+                continue
+            stages[stage] = {'count': n, **{f'p{int(q*100)}': round(Histogram.quantile(window, q) * 1000, 3)
+                                            for q in (0.5, 0.95, 0.99)}}
+        return {'timestamp': time.time(), 'stages_ms': stages, **self.read_values()}
+
+    def serve(self, port, host='127.0.0.1'):
+        '''Starts the HTTP endpoint on a daemon thread, returns False if the port could not be bound'''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # scrapes would fill the log
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logging.error(f"Error starting metrics endpoint on {host}:{port}: {e}")
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics_http', daemon=True).start()
+        logging.info(f"Metrics served on http://{host}:{port}/metrics")
+        return True
+
+    def report(self, callback, interval):
+        '''Calls callback with message() every interval seconds from a daemon thread'''
+        def run():
+            while not self.stop_event.wait(interval):
+                try:
+                    callback(self.message())
+                except Exception as e:
+                    logging.error(f"Error reporting metrics: {e}")
+        self.thread = threading.Thread(target=run, name='metrics_report', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
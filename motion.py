@@ -0,0 +1,221 @@
+import cv2
+import numpy as np
+from roi_signals import clamp_box
+
+
+# Farneback parameters, shared by the full frame and ROI paths
+FLOW_PYR_SCALE = 0.5
+FLOW_LEVELS = 3
+FLOW_WINSIZE = 15
+FLOW_ITERATIONS = 3
+FLOW_POLY_N = 5
+FLOW_POLY_SIGMA = 1.2
+
+def flow_roi(shape,
+             ul_bound_flow,
+             lr_bound_flow,
+             ul_bound_converyor,
+             lr_bound_conveyor):
+    '''Returns (x0, y0, x1, y1) covering the flow and conveyor boxes, padded so that the coarsest
+    pyramid level still sees a full window and polynomial neighbourhood around each box'''
+    pad = int((FLOW_WINSIZE // 2 + FLOW_POLY_N) / FLOW_PYR_SCALE ** (FLOW_LEVELS - 1))
+    height, width = shape[:2]
+    x0 = max(min(ul_bound_flow[0], ul_bound_converyor[0]) - pad, 0)
+    y0 = max(min(ul_bound_flow[1], ul_bound_converyor[1]) - pad, 0)
+    x1 = min(max(lr_bound_flow[0], lr_bound_conveyor[0]) + pad, width)
+    y1 = min(max(lr_bound_flow[1], lr_bound_conveyor[1]) + pad, height)
+    return x0, y0, x1, y1
+
+def optical_flow(prvs, next, mask, 
+                 ul_bound_flow, 
+                 lr_bound_flow, 
+                 ul_bound_converyor,
+                lr_bound_conveyor,
+                headless = False,
+                buffers = None):
+    '''Dense optical flow for the conveyor signals. When headless only the padded union of the flow and
+    conveyor boxes is processed and the visualisation is skipped (bgr is returned as None).
+    If a BufferPool is given the flow field, and on the full frame path the visualisation, are written into
+    reused buffers, bgr is then only valid until the next call with the same pool'''
+
+    if headless:
+        x0, y0, x1, y1 = flow_roi(next.shape, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor)
+        flow = None if buffers is None else buffers.get('flow_roi', (y1-y0, x1-x0, 2), np.float32)
+        flow = cv2.calcOpticalFlowFarneback(prvs[y0:y1, x0:x1], next[y0:y1, x0:x1], flow,
+                                            FLOW_PYR_SCALE, FLOW_LEVELS, FLOW_WINSIZE, FLOW_ITERATIONS,
+                                            FLOW_POLY_N, FLOW_POLY_SIGMA, 0)
+        flow_y = flow[:,:,1].mean()
+        flow_x = flow[:,:,0][ul_bound_flow[1]-y0:lr_bound_flow[1]-y0, ul_bound_flow[0]-x0:lr_bound_flow[0]-x0].mean()
+        flow_conv = flow[ul_bound_converyor[1]-y0:lr_bound_conveyor[1]-y0, ul_bound_converyor[0]-x0:lr_bound_conveyor[0]-x0].mean()
+        return None, mask, flow_x, flow_y, flow_conv
+
+    flow = None if buffers is None else buffers.get('flow', (*next.shape[:2], 2), np.float32)
+    flow = cv2.calcOpticalFlowFarneback(prvs, next, flow,
+                                        FLOW_PYR_SCALE, FLOW_LEVELS, FLOW_WINSIZE, FLOW_ITERATIONS,
+                                        FLOW_POLY_N, FLOW_POLY_SIGMA, 0)
+    if buffers is None:
+        mag, ang = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+        mask[..., 0] = ang*180/np.pi/2
+        mask[..., 2] = cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX)
+        bgr = cv2.cvtColor(mask, cv2.COLOR_HSV2BGR)
+    else:
+        # flow channels are copied out once and overwritten in place with magnitude and hue in degrees / 2
+        mag = cv2.extractChannel(flow, 0, buffers.get('flow_mag', next.shape[:2], np.float32))
+        ang = cv2.extractChannel(flow, 1, buffers.get('flow_ang', next.shape[:2], np.float32))
+        cv2.cartToPolar(mag, ang, mag, ang, angleInDegrees=True)
+        mask[..., 0] = cv2.multiply(ang, 0.5, dst=ang)
+        mask[..., 2] = cv2.normalize(mag, mag, 0, 255, cv2.NORM_MINMAX)
+        bgr = cv2.cvtColor(mask, cv2.COLOR_HSV2BGR, dst=buffers.get('flow_bgr', mask.shape))
+    #flow_x = flow[:,:,0].mean()
+    flow_y = flow[:,:,1].mean()
+    flow_x = flow[:,:,0][ul_bound_flow[1]:lr_bound_flow[1], ul_bound_flow[0]:lr_bound_flow[0]].mean()
+    #flow_x = flow[ul_bound_flow[1]:lr_bound_flow[1], ul_bound_flow[0]:lr_bound_flow[0]].mean()    
+    flow_conv = flow[ul_bound_converyor[1]:lr_bound_conveyor[1], ul_bound_converyor[0]:lr_bound_conveyor[0]].mean()
+    return bgr, mask, flow_x, flow_y, flow_conv
+
+
+class MotionEstimator:
+    '''Interface of the conveyor motion engines, selected with config.motion_engine (see motion_estimator).
+    estimate() takes the arguments of optical_flow and returns the same (bgr, mask, flow_x, flow_y, flow_conv):
+    flow_x is the mean x motion in the flow box, flow_conv the mean of the x and y motion in the conveyor box and
+    flow_y the mean y motion. bgr is a visualisation, None when headless.
+    sequential is True for engines that carry state from one frame pair to the next, the pipeline then estimates
+    frames one after the other, reset() drops that state after frames were skipped.'''
+
+    sequential = False
+
+    def estimate(self, prvs, next, mask, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor,
+                 headless = False, buffers = None):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+    def box_motions(self, prvs, next, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor):
+        height, width = next.shape[:2]
+        flow_box = clamp_box(ul_bound_flow, lr_bound_flow, width, height)
+        conveyor_box = clamp_box(ul_bound_converyor, lr_bound_conveyor, width, height)
+        return self.box_motion('flow', flow_box, prvs, next), self.box_motion('conveyor', conveyor_box, prvs, next)
+
+    def signals(self, next, flow_motion, conveyor_motion, headless):
+        bgr = None if headless else cv2.cvtColor(next, cv2.COLOR_GRAY2BGR)
+        return bgr, flow_motion[0], flow_motion[1], (conveyor_motion[0] + conveyor_motion[1]) / 2
+
+
+class FarnebackEstimator(MotionEstimator):
+    '''Dense Farneback flow over the padded boxes (headless) or the full frame, see optical_flow'''
+
+    def estimate(self, prvs, next, mask, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor,
+                 headless = False, buffers = None):
+        return optical_flow(prvs, next, mask, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor,
+                            headless = headless, buffers = buffers)
+
+
+class LucasKanadeEstimator(MotionEstimator):
+    '''Sparse pyramidal Lucas-Kanade tracking of corners inside each box. Corners found with goodFeaturesToTrack are
+    tracked from frame to frame and the box motion is the median displacement of the tracked points. Points that
+    are lost or leave the box are dropped, and the box is seeded again when fewer than min_points remain (or the
+    box changed). Only the boxes padded by the search window are passed to OpenCV, not the whole frame.
+    args: max_points: int: corners seeded per box
+          min_points: int: tracked points below which the box is seeded again
+          quality: float: goodFeaturesToTrack quality level
+          min_distance: int: smallest distance between seeded corners
+          win_size: int: Lucas-Kanade search window
+          levels: int: pyramid levels above the full resolution'''
+
+    sequential = True
+
+    def __init__(self, max_points=40, min_points=15, quality=0.01, min_distance=3, win_size=15, levels=2):
+        self.max_points = max_points
+        self.min_points = min_points
+        self.quality = quality
+        self.min_distance = min_distance
+        self.win_size = win_size
+        self.levels = levels
+        self.points = {} # box name -> (box, points in frame coordinates of the previous frame)
+
+    def reset(self):
+        self.points = {}
+
+    def estimate(self, prvs, next, mask, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor,
+                 headless = False, buffers = None):
+        flow_motion, conveyor_motion = self.box_motions(prvs, next, ul_bound_flow, lr_bound_flow,
+                                                        ul_bound_converyor, lr_bound_conveyor)
+        bgr, flow_x, flow_y, flow_conv = self.signals(next, flow_motion, conveyor_motion, headless)
+        if bgr is not None:
+            for box, points in self.points.values():
+                for x, y in points.reshape(-1, 2):
+                    cv2.circle(bgr, (int(x), int(y)), 2, (0, 255, 0), -1)
+        return bgr, mask, flow_x, flow_y, flow_conv
+
+    def box_motion(self, name, box, prvs, next):
+        x0, y0, x1, y1 = box
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return 0.0, 0.0
+        tracked = self.points.get(name)
+        if tracked is None or tracked[0] != box or len(tracked[1]) < self.min_points:
+            corners = cv2.goodFeaturesToTrack(prvs[y0:y1, x0:x1], self.max_points, self.quality, self.min_distance)
+            if corners is None:
+                self.points.pop(name, None)
+                return 0.0, 0.0
+            points = corners + np.float32([x0, y0])
+        else:
+            points = tracked[1]
+        # track inside the box padded by the search range of the coarsest level
+        height, width = next.shape[:2]
+        pad = self.win_size * 2 ** self.levels
+        cx0, cy0 = max(x0 - pad, 0), max(y0 - pad, 0)
+        cx1, cy1 = min(x1 + pad, width), min(y1 + pad, height)
+        offset = np.float32([cx0, cy0])
+        new, status, err = cv2.calcOpticalFlowPyrLK(prvs[cy0:cy1, cx0:cx1], next[cy0:cy1, cx0:cx1], points - offset,
+                                                    None, winSize=(self.win_size, self.win_size), maxLevel=self.levels)
+        ok = status.ravel() == 1
+        if not ok.any():
+            self.points.pop(name, None)
+            return 0.0, 0.0
+        new = new[ok] + offset
+        dx, dy = np.median((new - points[ok]).reshape(-1, 2), axis=0)
+        xy = new.reshape(-1, 2)
+        inside = (xy[:, 0] >= x0) & (xy[:, 0] < x1) & (xy[:, 1] >= y0) & (xy[:, 1] < y1)
+        self.points[name] = (box, new[inside])
+        return float(dx), float(dy)
+
+
+class PhaseCorrelationEstimator(MotionEstimator):
+    '''Global translation of each box between frames from phase correlation (cv2.phaseCorrelate with a Hanning
+    window), one FFT pair per box and no state between frames. Shifts with a correlation peak below min_response
+    (no texture, or no single dominant motion) count as no motion.
+    args: min_response: float: smallest phaseCorrelate response accepted'''
+
+    def __init__(self, min_response=0.05):
+        self.min_response = min_response
+        self.windows = {} # box shape -> Hanning window
+
+    def estimate(self, prvs, next, mask, ul_bound_flow, lr_bound_flow, ul_bound_converyor, lr_bound_conveyor,
+                 headless = False, buffers = None):
+        flow_motion, conveyor_motion = self.box_motions(prvs, next, ul_bound_flow, lr_bound_flow,
+                                                        ul_bound_converyor, lr_bound_conveyor)
+        bgr, flow_x, flow_y, flow_conv = self.signals(next, flow_motion, conveyor_motion, headless)
+        return bgr, mask, flow_x, flow_y, flow_conv
+
+    def box_motion(self, name, box, prvs, next):
+        x0, y0, x1, y1 = box
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return 0.0, 0.0
+        shape = (y1 - y0, x1 - x0)
+        window = self.windows.get(shape)
+        if window is None:
+            window = self.windows[shape] = cv2.createHanningWindow(shape[::-1], cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(np.float32(prvs[y0:y1, x0:x1]), np.float32(next[y0:y1, x0:x1]), window)
+        if response < self.min_response:
+            return 0.0, 0.0
+        return dx, dy
+
+
+ENGINES = {'farneback': FarnebackEstimator, 'lk': LucasKanadeEstimator, 'phase': PhaseCorrelationEstimator}
+
+def motion_estimator(name):
+    '''Returns a new estimator for config.motion_engine: 'farneback', 'lk' or 'phase' '''
+    if name not in ENGINES:
+        raise ValueError(f"Unknown motion engine {name}, expected one of {', '.join(ENGINES)}")
+    return ENGINES[name]()
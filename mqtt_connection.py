@@ -0,0 +1,81 @@
+import datetime
+import logging
+import paho.mqtt.client as mqtt
+
+
+class MqttConnection:
+    '''One long lived paho client per service, connected and reconnected by paho's network thread so a broker
+    outage never blocks the caller. connect_async is used for the first connection, and reconnects back off from
+    min_delay to max_delay seconds. The retained status topic gets 'offline' as the last will and an online message
+    on every (re)connect. Messages go through an MqttPublisher, which queues what cannot be sent yet.
+    usage: connection = MqttConnection(f'{config.cell_name}_{config.device_name}_v1.1', config.mqtt_host,
+                                       config.mqtt_port, config.mqtt_username, config.mqtt_password,
+                                       status_topic, publisher)
+           connection.start()
+           publisher.publish_cycle(cycle.db_row())
+           connection.stop()
+    args: client_id: str: MQTT client id, sessions persist across reconnects (clean_session False)
+          host: str: broker address, '' to run without a broker
+          port: int: broker port
+          username: str: broker user
+          password: str: broker password
+          status_topic: str: retained online/offline status topic
+          publisher: MqttPublisher: publishes through this connection's client
+          keepalive: int: seconds between keepalive pings
+          min_delay: float: first reconnect delay in seconds
+          max_delay: float: longest reconnect delay in seconds'''
+
+    def __init__(self, client_id, host, port, username, password, status_topic, publisher,
+                 keepalive=60, min_delay=1, max_delay=120):
+        self.host = host
+        self.port = port
+        self.status_topic = status_topic
+        self.publisher = publisher
+        self.keepalive = keepalive
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id, clean_session = False)
+        self.client.username_pw_set(username = username, password = password)
+        self.client.will_set(status_topic, 'offline', retain=True, qos = publisher.topic_qos(status_topic))
+        self.client.reconnect_delay_set(min_delay=min_delay, max_delay=max_delay)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        publisher.set_client(self.client)
+
+    def start(self):
+        if not self.host:
+            logging.info("No MQTT host configured, messages are kept until one is")
+            return
+        try:
+            self.client.connect_async(self.host, self.port, self.keepalive)
+        except Exception as e: # bad host or port, the network thread would not retry these
+            logging.error(f"Error starting MQTT connection to {self.host}:{self.port}: {e}")
+            return
+        self.client.loop_start()
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code.is_failure:
+            logging.error(f"MQTT connection refused: {reason_code}")
+            return
+        logging.info(f"MQTT connected to {self.host}:{self.port}")
+        current_time = datetime.datetime.now()
+        message = {'status':'online', 'timestamp':current_time.timestamp(), 'timestamp_human': current_time.strftime("%d-%m-%y %H:%M:%S")}
+        self.publisher.publish(self.status_topic, message, retain=True)
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        # runs on the network thread, which reconnects by itself, so only log here
+        if reason_code.is_failure:
+            logging.error(f"Unexpected MQTT disconnection: {reason_code}")
+
+    def stop(self, timeout=5):
+        '''Publishes the retained offline status, waits up to timeout seconds for it to be sent (acknowledged
+        for QoS 1) and disconnects'''
+        if self.client.is_connected():
+            info = self.client.publish(self.status_topic, 'offline', retain=True, qos = self.publisher.topic_qos(self.status_topic))
+            try:
+                info.wait_for_publish(timeout) # the network thread is still running and completes it
+            except (RuntimeError, ValueError) as e:
+                logging.error(f"Error publishing offline status: {e}")
+            self.client.disconnect()
+        self.client.loop_stop()
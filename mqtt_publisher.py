@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+import json
+import logging
+import paho.mqtt.client as mqtt
+from cycle_schema import COLUMNS
+
+
+class MqttPublisher:
+    '''Publishes through a paho client with per topic QoS, without losing cycles while the broker is unreachable.
+    Cycle messages are backed by their database rows: a row is marked published (CycleWriter.mark_published) once
+    the broker acknowledges its message, and rows still unpublished are replayed in batches from a background
+    thread whenever the client is connected, a limited number in flight at a time so live messages are not held up.
+    Other messages (status, daily and shift totals) are latest values: while disconnected only the last payload
+    per topic is kept, and it is sent once connected again. They are not resent when unacknowledged, so they are
+    only tracked for ack_timeout seconds and at most max_pending at a time, the oldest are dropped first.
+    usage: publisher = MqttPublisher(qos={'cycle_data': 1}, db_name=config.db_name, table=config.db_table,
+                                     cycle_topic=topic, mark_published=cycle_writer.mark_published, row_message=...)
+           publisher.start()
+           publisher.set_client(client) # once, MqttConnection does this for its client
+           publisher.publish_cycle(cycle.db_row())
+           publisher.publish(status_topic, message, retain=True)
+    args: qos: dict: QoS by the last level of the topic, e.g. {'cycle_data': 1, 'status': 1}
+          default_qos: int: QoS of topics not in qos
+          db_name: str: database holding the cycle rows, None when no cycles are published
+          table: str: table holding the cycle rows
+          cycle_topic: str: topic of the cycle messages
+          mark_published: callable: called with the ids of acknowledged cycle messages
+          row_message: callable: returns the message dict for a (id, timestamp, track_cycle, part_1, part_2, ct, sent) row
+          batch_size: int: unpublished rows replayed per batch
+          max_inflight: int: cycle messages awaiting acknowledgement before replay waits
+          interval: float: seconds between replay batches
+          ack_timeout: float: seconds before an unacknowledged cycle message is replayed, or another message dropped
+          max_pending: int: unacknowledged messages other than cycles tracked before the oldest are dropped
+          observe: callable: called with ('mqtt_publish', seconds) per publish call and ('mqtt_ack', seconds)
+                   from publish to acknowledgement, e.g. Metrics.observe'''
+
+    def __init__(self, qos=None, default_qos=1, db_name=None, table=None, cycle_topic=None, mark_published=None,
+                 row_message=None, batch_size=100, max_inflight=200, interval=0.5, ack_timeout=60, max_pending=1000,
+                 observe=None):
+        self.qos = qos or {}
+        self.default_qos = default_qos
+        self.db_name = db_name
+        self.table = table
+        self.cycle_topic = cycle_topic
+        self.mark_published = mark_published
+        self.row_message = row_message
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.interval = interval
+        self.ack_timeout = ack_timeout
+        self.max_pending = max_pending
+        self.observe = observe
+        self.client = None
+        self.lock = threading.Lock()
+        self.pending = {} # mid -> (cycle id or None for other messages, time sent)
+        self.early = set() # mids acknowledged before publish() returned
+        self.acked = set() # acknowledged cycle ids not yet seen as published in the database
+        self.latest = {} # topic -> (payload, qos, retain) not yet sent
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def topic_qos(self, topic):
+        return self.qos.get(topic.rsplit('/', 1)[-1], self.default_qos)
+
+    def set_client(self, client):
+        # paho reconnects the same client and resends unacknowledged messages under their mids (clean_session
+        # False), so pending is kept across reconnects, what is never acknowledged expires after ack_timeout
+        client.on_publish = self.on_publish
+        self.client = client
+
+    def connected(self):
+        client = self.client
+        return client is not None and client.is_connected()
+
+    def send(self, topic, payload, qos, retain=False, id=None):
+        '''Publishes one message, returns False if the client did not accept it'''
+        client = self.client
+        start = time.perf_counter()
+        try:
+            info = client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception as e:
+            logging.error(f"Error publishing to {topic}: {e}")
+            return False
+        if self.observe is not None:
+            self.observe('mqtt_publish', time.perf_counter() - start)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        with self.lock:
+            if info.mid in self.early:
+                self.early.discard(info.mid)
+                acked = True
+            else:
+                self.pending[info.mid] = (id, time.time())
+                acked = False
+        if acked and id is not None:
+            self.ack(id)
+        return True
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        # paho VERSION2 callback, from the network thread once the broker acknowledged the message (sent for QoS 0)
+        with self.lock:
+            if mid not in self.pending:
+                self.early.add(mid)
+                return
+            id, sent = self.pending.pop(mid)
+        if self.observe is not None:
+            self.observe('mqtt_ack', time.time() - sent)
+        if id is not None:
+            self.ack(id)
+
+    def ack(self, id):
+        with self.lock:
+            self.acked.add(id)
+        if self.mark_published is not None:
+            self.mark_published([id])
+
+    def publish(self, topic, message, retain=False, qos=None):
+        '''Sends a latest value message now, or keeps it until connected. message is a dict or str'''
+        payload = message if isinstance(message, str) else json.dumps(message)
+        qos = self.topic_qos(topic) if qos is None else qos
+        if self.connected() and self.send(topic, payload, qos, retain):
+            with self.lock:
+                self.latest.pop(topic, None)
+            return True
+        with self.lock:
+            self.latest[topic] = (payload, qos, retain)
+        return False
+
+    def publish_cycle(self, row):
+        '''Sends the message for a cycle row if connected, otherwise it is replayed from the database later'''
+        if not self.connected():
+            return False
+        return self.send(self.cycle_topic, json.dumps(self.row_message(row)), self.topic_qos(self.cycle_topic), id=row[0])
+
+    def flush_latest(self):
+        with self.lock:
+            latest = list(self.latest.items())
+        for topic, (payload, qos, retain) in latest:
+            if not self.send(topic, payload, qos, retain):
+                break
+            with self.lock:
+                if self.latest.get(topic) == (payload, qos, retain):
+                    del self.latest[topic]
+
+    def expire(self):
+        '''Drops messages other than cycles never acknowledged within ack_timeout, and the oldest beyond max_pending,
+        returns the number dropped'''
+        with self.lock:
+            expired = time.time() - self.ack_timeout
+            others = [(mid, sent) for mid, (id, sent) in self.pending.items() if id is None] # oldest first
+            excess = len(others) - self.max_pending
+            dropped = 0
+            for i, (mid, sent) in enumerate(others):
+                if i < excess or sent < expired:
+                    del self.pending[mid]
+                    dropped += 1
+            if len(self.early) > self.max_pending: # late acknowledgements of dropped messages
+                self.early.clear()
+        if dropped:
+            logging.error(f"Dropped {dropped} unacknowledged messages")
+        return dropped
+
+    def replay(self, con):
+        '''Publishes the next batch of unpublished cycle rows, returns the number sent'''
+        with self.lock:
+            expired = time.time() - self.ack_timeout
+            for mid, (id, sent) in list(self.pending.items()):
+                if sent < expired:
+                    del self.pending[mid] # never acknowledged, sent again below
+            skip = {id for id, sent in self.pending.values()} | self.acked
+        rows = con.execute(f"SELECT {COLUMNS} FROM {self.table} WHERE published = 0 ORDER BY id LIMIT ?",
+                           (self.batch_size + len(skip),)).fetchall()
+        with self.lock:
+            self.acked &= {row[0] for row in rows} # the others are marked published in the database now
+        sent = 0
+        for row in rows:
+            if row[0] in skip:
+                continue
+            if sent >= self.batch_size or len(self.pending) >= self.max_inflight or not self.publish_cycle(row):
+                break
+            sent += 1
+        if sent:
+            logging.info(f"Replayed {sent} unpublished cycles")
+        return sent
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='mqtt_publisher', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        con = sqlite3.connect(self.db_name, timeout=30) if self.db_name and self.cycle_topic else None
+        try:
+            while not self.stop_event.wait(self.interval):
+                self.expire()
+                if not self.connected():
+                    continue
+                try:
+                    self.flush_latest()
+                    if con is not None and len(self.pending) < self.max_inflight:
+                        self.replay(con)
+                except sqlite3.Error as e:
+                    logging.error(f"Error reading unpublished cycles: {e}")
+        finally:
+            if con is not None:
+                con.close()
+
+    def close(self, timeout=5):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
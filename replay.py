@@ -0,0 +1,209 @@
+from counter_config import config_default, get_config
+from counter_pipeline import CountingPipeline
+import cv2
+import numpy as np
+import argparse
+import csv
+import os
+import time
+from datetime import datetime, timedelta
+from dataclasses import replace
+
+# Offline replay of recorded footage through the counting pipeline used by casting_counter_1.1.py.
+# Frames come from a video file or a directory of images, either as fast as possible or paced at a fixed rate.
+# Frame times are simulated from the source frame rate, so the cycles found are the same on every run.
+# Per frame signals and detected cycles are written to CSV, and a per stage throughput summary is printed.
+# With --compare the footage is replayed once per motion engine and each engine's conveyor signals, cycles and flow
+# time are compared with Farneback's.
+# usage: python replay.py recording.mp4 --signals signals.csv --cycles cycles.csv
+#        python replay.py images/ --fps 10 --rate 10
+#        python replay.py recording.mp4 --compare lk,phase
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+SIGNAL_FIELDS = ['frame', 'timestamp', 'flow_x', 'flow_y', 'flow_conv',
+                 'hsv_1_mean', 'hsv_2_mean', 'brightness_1_mean', 'brightness_2_mean',
+                 'hsv_sum_1', 'hsv_sum_2', 'brightness_sum_1', 'brightness_sum_2', 'conv_mean']
+CYCLE_FIELDS = ['id', 'timestamp', 'cycle_length', 'part_1', 'part_2', 'ct', 'box']
+
+
+def open_source(path, fps=None):
+    '''Returns (frames, fps) for a video file or a directory of images, frames is an iterator of BGR images'''
+    if os.path.isdir(path):
+        files = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+        def frames():
+            for f in files:
+                frame = cv2.imread(os.path.join(path, f))
+                if frame is not None:
+                    yield frame
+        return frames(), fps or 10.0
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video {path}")
+
+    def frames():
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame
+        finally:
+            cap.release()
+    return frames(), fps or cap.get(cv2.CAP_PROP_FPS) or 10.0
+
+
+def replay(source, config, fps=None, rate=0, signals_path=None, cycles_path=None, limit=None,
+           start_time=datetime(2024, 1, 1, 6, 0)):
+    '''Runs every frame of source through a CountingPipeline and returns a summary dict.
+    rate paces the replay in frames per second, 0 runs as fast as possible'''
+    frames, fps = open_source(source, fps)
+    frame_interval = timedelta(seconds=1/fps)
+
+    signals_file = open(signals_path, 'w', newline='') if signals_path else None
+    cycles_file = open(cycles_path, 'w', newline='') if cycles_path else None
+    signals_writer = csv.writer(signals_file) if signals_file else None
+    cycles_writer = csv.writer(cycles_file) if cycles_file else None
+    if signals_writer:
+        signals_writer.writerow(SIGNAL_FIELDS)
+    if cycles_writer:
+        cycles_writer.writerow(CYCLE_FIELDS)
+
+    totals = {'decode': 0.0}
+    cycles = []
+    pipeline = None
+    count = 0
+    replay_start = time.perf_counter()
+    try:
+        while limit is None or count < limit:
+            t0 = time.perf_counter()
+            frame = next(frames, None)
+            if frame is None:
+                break
+            totals['decode'] += time.perf_counter() - t0
+            now = start_time + count * frame_interval
+
+            if pipeline is None:
+                pipeline = CountingPipeline(config, frame, start_time)
+                for stage in pipeline.stage_times:
+                    totals[stage] = 0.0
+            cycle = pipeline.process(frame, now)
+            for stage, seconds in pipeline.stage_times.items():
+                totals[stage] += seconds
+
+            counter = pipeline.counter
+            if signals_writer:
+                signals_writer.writerow([count, now.timestamp(), pipeline.flow_x, pipeline.flow_y, pipeline.flow_conv,
+                                         pipeline.hsv_1_mean, pipeline.hsv_2_mean,
+                                         pipeline.brightness_1_mean, pipeline.brightness_2_mean,
+                                         counter.hsv_sum_1, counter.hsv_sum_2,
+                                         counter.brightness_sum_1, counter.brightness_sum_2, counter.conv_mean()])
+            if cycle is not None:
+                cycles.append(cycle)
+                if cycles_writer:
+                    cycles_writer.writerow(cycle.db_row())
+            count += 1
+
+            if rate:
+                delay = replay_start + count/rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+    finally:
+        if signals_file:
+            signals_file.close()
+        if cycles_file:
+            cycles_file.close()
+
+    elapsed = time.perf_counter() - replay_start
+    return {'frames': count,
+            'cycles': len(cycles),
+            'elapsed': elapsed,
+            'fps': count/elapsed if elapsed else 0.0,
+            'stage_ms': {stage: 1000*seconds/count for stage, seconds in totals.items()} if count else {},
+            'stage_fps': {stage: count/seconds for stage, seconds in totals.items() if seconds} if count else {}}
+
+
+def engine_signals(source, config, engine, fps=None, limit=None, start_time=datetime(2024, 1, 1, 6, 0)):
+    '''Replays source with config.motion_engine set to engine, returns flow_x and flow_conv per frame, the cycles
+    and the mean flow time in seconds'''
+    config = replace(config, motion_engine=engine)
+    frames, fps = open_source(source, fps)
+    frame_interval = timedelta(seconds=1/fps)
+    pipeline = None
+    flow_x, flow_conv, cycles = [], [], []
+    flow_time = 0.0
+    for count, frame in enumerate(frames):
+        if limit is not None and count >= limit:
+            break
+        if pipeline is None:
+            pipeline = CountingPipeline(config, frame, start_time)
+        cycle = pipeline.process(frame, start_time + count * frame_interval)
+        flow_time += pipeline.stage_times['flow']
+        flow_x.append(pipeline.flow_x)
+        flow_conv.append(pipeline.flow_conv)
+        if cycle is not None:
+            cycles.append(cycle)
+    return np.array(flow_x, float), np.array(flow_conv, float), cycles, flow_time / max(len(flow_x), 1)
+
+
+def compare_engines(source, config, engines, fps=None, limit=None, tolerance=1.0):
+    '''Compares the conveyor signals and cycles of each engine with Farneback on the same footage.
+    For flow_x and flow_conv: correlation, least squares gain (engine * gain ~ farneback) and mean absolute error.
+    Cycles match when they start within tolerance seconds of a Farneback cycle.'''
+    reference = engine_signals(source, config, 'farneback', fps, limit)
+    results = {}
+    for engine in ['farneback'] + [e for e in engines if e != 'farneback']:
+        flow_x, flow_conv, cycles, flow_time = reference if engine == 'farneback' else engine_signals(source, config, engine, fps, limit)
+        result = {'flow_ms': flow_time * 1000, 'speedup': reference[3] / flow_time if flow_time else float('inf'),
+                  'cycles': len(cycles), 'reference_cycles': len(reference[2])}
+        for name, values, expected in (('flow_x', flow_x, reference[0]), ('flow_conv', flow_conv, reference[1])):
+            valid = np.isfinite(values) & np.isfinite(expected)
+            values, expected = values[valid], expected[valid]
+            spread = values.std() * expected.std()
+            result[f'{name}_corr'] = float(np.mean((values - values.mean()) * (expected - expected.mean())) / spread) if spread else float('nan')
+            result[f'{name}_gain'] = float(values @ expected / (values @ values)) if values.any() else float('nan')
+            result[f'{name}_mae'] = float(np.abs(values - expected).mean()) if len(values) else float('nan')
+        starts = np.array([c.timestamp for c in reference[2]])
+        result['matched_cycles'] = sum(1 for c in cycles if len(starts) and np.abs(starts - c.timestamp).min() <= tolerance)
+        results[engine] = result
+    return results
+
+
+def print_comparison(results):
+    print(f"{'engine':<10} {'flow ms':>8} {'speedup':>8} {'cycles':>12} {'x corr':>7} {'x gain':>7} {'x mae':>7} "
+          f"{'conv corr':>9} {'conv gain':>9} {'conv mae':>8}")
+    for engine, r in results.items():
+        print(f"{engine:<10} {r['flow_ms']:8.3f} {r['speedup']:8.1f} {r['matched_cycles']:>5}/{r['cycles']:<2}({r['reference_cycles']:>2}) "
+              f"{r['flow_x_corr']:7.3f} {r['flow_x_gain']:7.3f} {r['flow_x_mae']:7.3f} "
+              f"{r['flow_conv_corr']:9.3f} {r['flow_conv_gain']:9.3f} {r['flow_conv_mae']:8.3f}")
+
+
+def print_summary(summary):
+    print(f"{summary['frames']} frames, {summary['cycles']} cycles in {summary['elapsed']:.2f} s "
+          f"({summary['fps']:.1f} frames/s)")
+    for stage, ms in summary['stage_ms'].items():
+        print(f"  {stage:<8} {ms:8.3f} ms/frame  {summary['stage_fps'].get(stage, float('inf')):10.1f} frames/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded footage through the counting pipeline')
+    parser.add_argument('source', help='video file or directory of images')
+    parser.add_argument('--config', default='config.yaml', help='counter config, first yaml document')
+    parser.add_argument('--fps', type=float, default=None, help='source frame rate used for frame times')
+    parser.add_argument('--rate', type=float, default=0, help='replay rate in frames/s, 0 for as fast as possible')
+    parser.add_argument('--signals', default=None, help='CSV file for per frame signals')
+    parser.add_argument('--cycles', default=None, help='CSV file for detected cycles')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--video', action='store_true', help='compute the full frame flow visualisation as in video mode')
+    parser.add_argument('--compare', default=None, help='comma separated motion engines to compare with farneback, e.g. lk,phase')
+    args = parser.parse_args()
+
+    config_mtime, config = get_config(args.config, 0, config_default())
+    config.video = args.video
+    if args.compare:
+        print_comparison(compare_engines(args.source, config, args.compare.split(','), args.fps, args.limit))
+        raise SystemExit
+    summary = replay(args.source, config, args.fps, args.rate, args.signals, args.cycles, args.limit)
+    print_summary(summary)
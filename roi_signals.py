@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+
+
+def clamp_box(ul_bound, lr_bound, width, height):
+    '''Clamps a box given as upper left / lower right corners to the frame, returns (x0, y0, x1, y1)'''
+    x0 = min(max(ul_bound[0], 0), width)
+    y0 = min(max(ul_bound[1], 0), height)
+    x1 = min(max(lr_bound[0], x0), width)
+    y1 = min(max(lr_bound[1], y0), height)
+    return x0, y0, x1, y1
+
+
+class SignalExtractor:
+    '''Single pass colour and brightness signals for the two hsv boxes.
+    The union of the boxes is cropped once per frame and converted to HSV and gray into preallocated
+    buffers. Each box is then masked and thresholded into its own buffer, so no full frame arrays are created.
+    Gives the same means as hsv_segmentation -> BGR2GRAY and brightness_thresh over the same boxes.
+    usage: extractor = SignalExtractor()
+           hsv_1_mean, hsv_2_mean, brightness_1_mean, brightness_2_mean = extractor.extract(frame, config)
+    Buffers are reallocated only when the frame size or the box positions change.'''
+
+    def __init__(self):
+        self.layout = None
+        self.roi = None
+        self.boxes = None
+        self.hsv = None
+        self.gray = None
+        self.masks = None
+        self.masked = None
+        self.bright = None
+
+    def allocate(self, layout):
+        width, height, box_1, box_2 = layout
+        box_1 = clamp_box(box_1[0], box_1[1], width, height)
+        box_2 = clamp_box(box_2[0], box_2[1], width, height)
+        x0 = min(box_1[0], box_2[0])
+        y0 = min(box_1[1], box_2[1])
+        x1 = max(box_1[2], box_2[2])
+        y1 = max(box_1[3], box_2[3])
+        self.roi = (x0, y0, x1, y1)
+        # box positions relative to the cropped roi
+        self.boxes = [(b[0]-x0, b[1]-y0, b[2]-x0, b[3]-y0) for b in (box_1, box_2)]
+        self.hsv = np.empty((y1-y0, x1-x0, 3), np.uint8)
+        self.gray = np.empty((y1-y0, x1-x0), np.uint8)
+        self.masks = [np.empty((b[3]-b[1], b[2]-b[0]), np.uint8) for b in self.boxes]
+        self.masked = [np.empty_like(m) for m in self.masks]
+        self.bright = [np.empty_like(m) for m in self.masks]
+        self.layout = layout
+
+    def extract(self, frame, config):
+        '''Returns hsv_1_mean, hsv_2_mean, brightness_1_mean, brightness_2_mean for the configured boxes'''
+        height, width = frame.shape[:2]
+        layout = (width, height,
+                  (tuple(config.ul_bound_hsv), tuple(config.lr_bound_hsv)),
+                  (tuple(config.ul_bound_hsv_2), tuple(config.lr_bound_hsv_2)))
+        if layout != self.layout:
+            self.allocate(layout)
+
+        x0, y0, x1, y1 = self.roi
+        cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2HSV, dst=self.hsv)
+        cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        hsv_1_mean, brightness_1_mean = self.box_means(0, config.HSLlower_1, config.HSLupper_1, config.brightness_thresh)
+        hsv_2_mean, brightness_2_mean = self.box_means(1, config.HSLlower, config.HSLupper, config.brightness_thresh)
+        return hsv_1_mean, hsv_2_mean, brightness_1_mean, brightness_2_mean
+
+    def box_means(self, i, HSLlower, HSLupper, lower):
+        bx0, by0, bx1, by1 = self.boxes[i]
+        if bx1 <= bx0 or by1 <= by0:
+            return np.nan, np.nan
+        hsv = self.hsv[by0:by1, bx0:bx1]
+        gray = self.gray[by0:by1, bx0:bx1]
+        cv2.inRange(hsv, np.array(HSLlower, int), np.array(HSLupper, int), dst=self.masks[i])
+        # the mask is 0 or 255, so a plain and gives the gray level of the masked colour image
+        cv2.bitwise_and(gray, self.masks[i], dst=self.masked[i])
+        cv2.threshold(gray, lower, 255, cv2.THRESH_BINARY, dst=self.bright[i])
+        return cv2.mean(self.masked[i])[0], cv2.mean(self.bright[i])[0]
@@ -0,0 +1,52 @@
+import math
+
+
+class RollingWindow:
+    '''Fixed size window of the most recent values with a running sum, a drop in replacement for
+    sum() or statistics.mean() over a deque(maxlen=size) that costs O(1) per append.
+    The running sum is recomputed exactly with math.fsum every resync appends, and whenever a
+    non finite value leaves the window, so rounding drift and a passing nan cannot accumulate.
+    usage: conv_window = RollingWindow(5)
+           conv_window.append(flow_conv)
+           conv_window.mean()
+    args: size: int: number of values in the window
+          initial: float: value the window is filled with before any append
+          resync: int: appends between exact recomputations of the sum'''
+
+    def __init__(self, size, initial=0.0, resync=1000):
+        if size < 1:
+            raise ValueError("RollingWindow size must be at least 1")
+        self.size = size
+        self.values = [float(initial)] * size
+        self.index = 0
+        self.total = float(initial) * size
+        self.resync = resync
+        self.updates = 0
+
+    def append(self, value):
+        value = float(value)
+        old = self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.updates += 1
+        if self.updates >= self.resync or not math.isfinite(old):
+            try:
+                self.total = math.fsum(self.values)
+            except ValueError: # inf and -inf both in the window
+                self.total = math.nan
+            self.updates = 0
+        else:
+            self.total += value - old
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        return self.total / self.size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        '''values from oldest to newest'''
+        return iter(self.values[self.index:] + self.values[:self.index])
@@ -0,0 +1,77 @@
+from counter_config import config_default, get_config
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+# Startup time of the counter and processor, to check a restart after a crash gets back to counting quickly.
+# Imports are timed in fresh interpreters: the modules each entry point loads, and what the frame reader process
+# loads when it is started with spawn (the Windows default), which runs casting_counter_1.1.py again as __mp_main__.
+# Given a source (video file or camera url), the time from starting the frame reader to the first frame and to the
+# first frame through the counting pipeline is measured as well.
+# usage: python startup_benchmark.py
+#        python startup_benchmark.py recording.mp4 --spawn --repeat 5
+
+IMPORTS = {'reader process': "import runpy; runpy.run_path('casting_counter_1.1.py', run_name='__mp_main__'); import manageRTSP",
+           'counter': "import counter_app",
+           'processor': "import disa_processor_to_mqtt",
+           'dashboard data': "import dashboard_data"}
+
+
+def import_time(statement, repeat=3):
+    '''Best of repeat fresh interpreter runs from this directory, in seconds, of statement and the modules it loaded'''
+    code = (f"import sys, time; before = set(sys.modules); t = time.perf_counter(); {statement}; "
+            f"print(time.perf_counter() - t, ' '.join(sorted({{m.split('.')[0] for m in set(sys.modules) - before}})))")
+    best, modules = None, ''
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split(' ', 1)
+        if best is None or float(out[0]) < best:
+            best, modules = float(out[0]), out[1].strip()
+    return best, modules
+
+
+def first_frame_time(source, config):
+    '''Seconds from starting a FrameReader to its first frame and to the first processed frame'''
+    import manageRTSP as rtsp
+    from counter_pipeline import CountingPipeline, read_frame
+    start = time.perf_counter()
+    frame_reader = rtsp.FrameReader(source, shared_memory=config.shared_memory,
+                                    max_frame_shape=config.shared_memory_shape, decimate=config.reader_decimate,
+                                    target_fps=config.reader_fps, scale=config.reader_scale,
+                                    hw_decode=config.reader_hw_decode)
+    frame_reader.start_frame_reader()
+    try:
+        frame = read_frame(frame_reader)
+        first_frame = time.perf_counter() - start
+        pipeline = CountingPipeline(config, frame)
+        pipeline.process(read_frame(frame_reader))
+        first_processed = time.perf_counter() - start
+    finally:
+        frame_reader.close()
+    return first_frame, first_processed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure startup time of the counter and processor')
+    parser.add_argument('source', nargs='?', default=None, help='video file or camera url for the first frame timings')
+    parser.add_argument('--config', default='config.yaml', help='counter config, first yaml document')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is reported')
+    parser.add_argument('--spawn', action='store_true', help='start the frame reader with spawn as on Windows')
+    args = parser.parse_args()
+
+    print("imports (fresh interpreter, best of runs)")
+    for name, statement in IMPORTS.items():
+        seconds, modules = import_time(statement, args.repeat)
+        print(f"  {name:<15} {seconds*1000:8.1f} ms  {modules}")
+
+    if args.source:
+        if args.spawn:
+            multiprocessing.set_start_method('spawn')
+        _, config = get_config(args.config, 0, config_default())
+        config.video = False
+        times = [first_frame_time(args.source, config) for _ in range(args.repeat)]
+        print(f"first frame     {min(t[0] for t in times)*1000:8.1f} ms")
+        print(f"first processed {min(t[1] for t in times)*1000:8.1f} ms")
@@ -1,6 +1,5 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
 import datetime
 import time
 import matplotlib.pyplot as plt
@@ -8,6 +7,7 @@ import paho.mqtt.client as mqtt
 import json
 import pytz
 import numpy as np
+from dashboard_data import DashboardData
 
 
 
@@ -56,77 +56,46 @@ ave_overall_pph_holder = col16.empty()
 st.subheader('Daily performance, 5 minute rolling average')
 perf_chart = st.empty()
 
-con = sqlite3.connect("disa3v1.db")
 lon = pytz.timezone("Europe/London")
 
-while True:
 
-    current_time = datetime.datetime.now(lon)
-    target_date = datetime.datetime(year = current_time.year,
-                                      month = current_time.month,
-                                      day = current_time.day,
-                                      hour = 4,
-                                      minute = 30).timestamp()
-    try:
-        cur = con.cursor()
-    except:
-        con = sqlite3.connect("disa3v1.db")
-    data = pd.read_sql(f'select * from counter where id > {target_date}', con)
-    data = data.iloc[1:,:]
-    #con.close()
-    if len(data)<5: # if no data in table
-        time.sleep(10)
-        continue
+@st.cache_resource
+def dashboard_data():
+    # one refresher per server process, shared by every browser session
+    data = DashboardData("disa3v1.db", 'counter', event_port = 47651, idle_poll = 30)
+    data.start()
+    return data
 
-    data['timestamp'] = pd.to_datetime(data['timestamp'], unit = 's', utc = True)
-    data['running'] = ( data['timestamp']-data['timestamp'].shift(1)).dt.total_seconds()<45
-    data['ct2'] = data['timestamp'].diff(1).dt.total_seconds().fillna(0)
-    data = data[data['ct2']>7]
-    data = data[data['track_cycle']<10]
-    total_cycles_shift = data['ct'].count()
 
+shared_data = dashboard_data()
+version = 0
+snapshot = None
 
-    try:
-        image = f'images/{data['id'].max()}.jpg'
-    except:
-        pass
+while True:
 
-    total_stopped_time = data[data['running']==False]['ct'].sum()
-    total_cycling_time = data[data['running']==True]['ct'].sum()
-    total_1_parts_cast = data['part_1'].sum()+0.01 
-    total_2_parts_cast = data['part_2'].sum()+0.01 
-    total_cycles = len(data)
-    time_on_hold = (current_time - data['timestamp'].max()).seconds
-    ave_cycle_last_10 = data['ct'][-10:].mean()
+    current_time = datetime.datetime.now(lon)
+    # redraw the figures only when the shared data has changed, the clock and time on hold every 0.5 s
+    snapshot = shared_data.wait(version, 0.5)
+    if snapshot is None or snapshot['rows']<5: # if no data in table
+        time.sleep(10)
+        continue
+    redraw = snapshot['version'] != version
+    version = snapshot['version']
+
+    image = snapshot['image']
+    total_stopped_time = snapshot['total_stopped_time']
+    total_cycling_time = snapshot['total_cycling_time']
+    total_1_parts_cast = snapshot['total_1_parts_cast']
+    total_2_parts_cast = snapshot['total_2_parts_cast']
+    total_cycles = snapshot['total_cycles']
+    time_on_hold = (current_time - snapshot['last_cycle']).seconds
+    ave_cycle_last_10 = snapshot['ave_cycle_last_10']
+    time_first_cycle = snapshot['time_first_cycle']
+    time_fist_box = snapshot['time_first_box']
+    time_first_pour = snapshot['time_first_pour']
 
-    time_first_cycle = data['timestamp'].min()
-    try:
-        time_fist_box = data[data['sent']==1].iloc[0,:]['timestamp'] 
-    except:
-        time_fist_box = None
-
-
-    times_state = (data[data['part_1']==1].empty, data[data['part_2']==1].empty)
-    match times_state:
-        case (True, True):
-            time_first_pour = None
-        case (False, True):
-            time_first_pour =  data[data['part_1']==1].iloc[0,:]['timestamp']
-        case (True, False):
-            time_first_pour =  data[data['part_2']==1].iloc[0,:]['timestamp']
-        case (False, False):
-            time_first_pour =  min(data[data['part_1']==1].iloc[0,:]['timestamp'], data[data['part_2']==1].iloc[0,:]['timestamp'])
-
-    data['ave_pph'] = 3600/data['ct'].rolling(20).mean()
-
-    data2 = data.copy()
-    data2.set_index('timestamp', inplace = True)
-    data2['rolling_ave'] = (3600/data2.rolling('10min', min_periods=3).mean())['ct']
-    data2['rolling_ave_part_1'] = (3600/data2[data2['part_1']==1].rolling('10min', min_periods=3).mean())['ct']
-    data2['rolling_ave_part_2'] = (3600/data2[data2['part_2']==1].rolling('10min', min_periods=3).mean())['ct']
-    
     cur_time_holder.write(f'{current_time.strftime('%A %B %d %H:%M:%S')}')
-    time_last_cycled_holder.write(f'Time last cycled {data['timestamp'].max().astimezone(lon).strftime('%H:%M:%S')}')
+    time_last_cycled_holder.write(f'Time last cycled {snapshot['last_cycle'].astimezone(lon).strftime('%H:%M:%S')}')
     time_on_hold_holder.write(f'Time since last cycle {time_on_hold} s')
     try:
         time_first_cycle_holder.write(f'First cycle {time_first_cycle.strftime('%H:%M:%S')}')
@@ -157,6 +126,9 @@ while True:
             # client.publish("tdg/tdf/disa3/cycle_counter/running", message, retain=True, qos=2)
 
     
+    if not redraw:
+        continue
+
     ave_cycle_time_holder.write(f'Average cycle time last 10 cycles {ave_cycle_last_10:.2f} seconds')
     ave_cycle_time_holder_pph.markdown(f'## {3600/ave_cycle_last_10:.2f} bph')
 
@@ -172,13 +144,8 @@ while True:
     #                       y_label = 'Rolling BPH (20 cycles)',
     #                       x_label = 'Time (UTC)',
     #                       height = 300)
-    perf_chart.line_chart(data2,  y = ['rolling_ave', 'rolling_ave_part_1','rolling_ave_part_2' ], 
+    perf_chart.line_chart(snapshot['chart'],  y = ['rolling_ave', 'rolling_ave_part_1','rolling_ave_part_2' ], 
                           color = [(1.0,0,0, 0.1), (0,1.0,0), (0,0,1.0)], 
                           y_label = 'Rolling BPH (5 min window)',
                           x_label = 'Time (UTC)',
                           height = 300)
-
-
-
-    time.sleep(0.5)
-